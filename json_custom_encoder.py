@@ -2,10 +2,14 @@
 Format for json output
 Modified from https://stackoverflow.com/questions/16264515/json-dumps-custom-formatting
 
+The encoder is incremental: iterencode() is a generator that yields the document in small pieces,
+so json.dump() writes a large document to a file without building it in memory
+
 Michael Gribskov     21 February 2024
 ================================================================================================="""
 import json
 
+
 class CompactJSONEncoder(json.JSONEncoder):
     """A JSON Encoder that puts small lists on single lines."""
 
@@ -13,50 +17,109 @@ class CompactJSONEncoder(json.JSONEncoder):
         super().__init__(*args, **kwargs)
         self.indentation_level = 0
 
+        # scalars (and dictionary keys) are encoded with the standard encoder and the same options
+        self.scalar = json.JSONEncoder(skipkeys=self.skipkeys, ensure_ascii=self.ensure_ascii,
+                                       allow_nan=self.allow_nan, default=self.default)
+
     def encode(self, o):
         """Encode JSON object *o* with respect to single line lists."""
+        return ''.join(self.iterencode(o))
+
+    def iterencode(self, o, _one_shot=False):
+        """-----------------------------------------------------------------------------------------
+        Generator over the pieces of the encoded document, used by json.dump(). Lists that fit on
+        a single line are yielded as one piece, other lists and dictionaries one element at a time
 
+        :param o: object        object to encode
+        :param _one_shot: bool  not used, for compatibility with json.JSONEncoder
+        :return: str            next piece of the document
+        -----------------------------------------------------------------------------------------"""
         if isinstance(o, (list, tuple)):
-            if self._is_single_line_list(o):
-                return "[" + ", ".join(json.dumps(el) for el in o) + "]"
-            else:
-                self.indentation_level += 1
-                output = [self.indent_str + self.encode(el) for el in o]
-                self.indentation_level -= 1
-                return "[\n" + ",\n".join(output) + "\n" + self.indent_str + "]"
+            line = self._single_line_list(o)
+            if line is not None:
+                yield line
+                return
+
+            self.indentation_level += 1
+            indent = self.indent_str
+            separator = '[\n'
+            for el in o:
+                yield separator + indent
+                yield from self.iterencode(el)
+                separator = ',\n'
+            self.indentation_level -= 1
+            yield '\n' + self.indent_str + ']'
 
         elif isinstance(o, dict):
+            if not o:
+                yield '{}'
+                return
+
             self.indentation_level += 1
-            output = [self.indent_str + f"{json.dumps(k)}: {self.encode(v)}" for k, v in o.items()]
+            indent = self.indent_str
+            separator = '{\n'
+            for k, v in o.items():
+                key = self._key(k)
+                if key is None:
+                    continue
+                yield f'{separator}{indent}{key}: '
+                yield from self.iterencode(v)
+                separator = ',\n'
             self.indentation_level -= 1
-            return "{\n" + ",\n".join(output) + "\n" + self.indent_str + "}"
+            yield '\n' + self.indent_str + '}'
 
         else:
-            return json.dumps(o)
+            yield self.scalar.encode(o)
 
-    def _is_single_line_list(self, o):
+    def _single_line_list(self, o):
         """-----------------------------------------------------------------------------------------
-        This controls what should be a single line
+        This controls what should be a single line: lists of at most n_items scalars whose
+        elements and separators fit in line_len characters. The length is the sum of the encoded
+        elements, the list is not converted to a string to measure it
 
         :param o: list      list to format
-        :return:
+        :return: str        the list on one line, or None if it needs more than one line
         -----------------------------------------------------------------------------------------"""
         n_items = 5
         line_len = 120
-        if isinstance(o, (list, tuple)):
-            return not any(isinstance(el, (list, tuple, dict)) for el in o) \
-                and len(o) <= n_items \
-                and len(str(o)) - 2 <= line_len
+        if len(o) > n_items or any(isinstance(el, (list, tuple, dict)) for el in o):
+            return None
+
+        encoded = [self.scalar.encode(el) for el in o]
+        if sum(len(el) for el in encoded) + 2 * (len(encoded) - 1) > line_len:
+            return None
+
+        return '[' + ', '.join(encoded) + ']'
+
+    def _key(self, k):
+        """-----------------------------------------------------------------------------------------
+        Dictionary keys are strings in JSON; numbers, booleans, and None are converted as
+        json.dumps() does
+
+        :param k: object    dictionary key
+        :return: str        encoded key, None if the key is skipped (skipkeys)
+        -----------------------------------------------------------------------------------------"""
+        if isinstance(k, str):
+            return self.scalar.encode(k)
+        if isinstance(k, (int, float, bool)) or k is None:
+            return self.scalar.encode(self.scalar.encode(k))
+        if self.skipkeys:
+            return None
+
+        raise TypeError(f'keys must be str, int, float, bool or None, not {type(k).__name__}')
 
     @property
     def indent_str(self) -> str:
         return " " * self.indentation_level * self.indent
 
-    def iterencode(self, o, **kwargs):
-        """Required to also work with `json.dump`."""
-        return self.encode(o)
+
 # --------------------------------------------------------------------------------------------------
 #
 # --------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    test = {'short': [1, 2, 3], 'long': list(range(8)), 'nested': [[1, 2], [3]], 0.25: {}}
+    text = json.dumps(test, indent=2, cls=CompactJSONEncoder)
+    print(text)
+    print(f'valid json: {json.loads(text) == json.loads(json.dumps(test))}')
+
     exit(0)
@@ -0,0 +1,239 @@
+"""=================================================================================================
+orthogroups:og_cache.py
+
+Cache of normalized results. Each entry is a directory of .npy arrays (e.g. counts, z, and the row
+statistics) and a meta.json file, and is named by a key made from the content hash of the
+orthogroups file and the parameters of the calculation. The arrays are memory mapped when an entry
+is loaded, so a run with a different target set or output format does not parse the orthogroups
+file or normalize the counts again
+
+The content hash of each orthogroups file is remembered with the file size and modification time
+(files.json), so the file is hashed again only when it changes. The modification time of an
+entry's meta.json is its last use; when the cache is larger than its size limit the least recently
+used entries are removed
+
+usage
+    cache = ResultCache('og_results', limit=1 << 30)
+    key = cache.key('Orthogroups.tsv', fraction=0.5, method='trimmed', ignore_zero=False)
+    entry = cache.load(key)
+    if entry is None:
+        ...
+        cache.save(key, {'counts': counts, 'z': z}, {'proteome': proteome})
+
+18 October 2026
+================================================================================================="""
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from orthogroups import Orthogroup
+
+
+class ResultCache:
+    """=============================================================================================
+    Directory of cached results with least recently used eviction
+
+    cache_version is part of every key, change it when the stored results change
+    ============================================================================================="""
+
+    cache_version = 2
+
+    def __init__(self, cachedir, limit=1 << 30):
+        """-----------------------------------------------------------------------------------------
+        :param cachedir: string     cache directory, created if it does not exist
+        :param limit: int           maximum total size of the entries in bytes
+        -----------------------------------------------------------------------------------------"""
+        self.cachedir = cachedir
+        self.limit = limit
+
+    def key(self, filename, **params):
+        """-----------------------------------------------------------------------------------------
+        Cache key for the results of filename calculated with params. The parameters must be
+        JSON serializable
+
+        :param filename: string     orthogroups file
+        :param params: dict         parameters of the calculation
+        :return: string             hex key, also the name of the entry directory
+        -----------------------------------------------------------------------------------------"""
+        content = self.file_hash(filename)
+        text = json.dumps([ResultCache.cache_version, content, params], sort_keys=True)
+
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def file_hash(self, filename):
+        """-----------------------------------------------------------------------------------------
+        Content hash of filename (Orthogroup.file_hash()). The hash is saved in files.json with the
+        size and modification time of the file and reused while they are unchanged
+
+        :param filename: string     path to file
+        :return: string             blake2b hex digest
+        -----------------------------------------------------------------------------------------"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        known = self.json_read('files.json') or {}
+        if known.get(path, [None, None, None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[path][2]
+
+        digest = Orthogroup.file_hash(path)
+        known[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(os.path.join(self.cachedir, 'files.json'), 'w') as fh:
+                json.dump(known, fh)
+        except OSError:
+            sys.stderr.write(f'ResultCache.file_hash() - cannot write cache ({self.cachedir})\n')
+
+        return digest
+
+    def load(self, key):
+        """-----------------------------------------------------------------------------------------
+        Memory map the arrays of a cache entry and mark the entry as used
+
+        :param key: string      cache key
+        :return: dict           {'meta': dict, name: np.ndarray, ...}, None if there is no entry
+        -----------------------------------------------------------------------------------------"""
+        meta = self.json_read(key, 'meta.json')
+        if meta is None:
+            return None
+
+        entry = {'meta': meta}
+        try:
+            for name in meta['arrays']:
+                entry[name] = np.load(os.path.join(self.cachedir, key, f'{name}.npy'), mmap_mode='r')
+            os.utime(os.path.join(self.cachedir, key, 'meta.json'))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return entry
+
+    def save(self, key, arrays, meta=None, keep=()):
+        """-----------------------------------------------------------------------------------------
+        Write a cache entry and evict old entries if the cache is over its limit. The entry is
+        written in a temporary directory that is renamed when it is complete, so an incomplete
+        entry is never loaded. An existing entry is first renamed out of the way and then removed,
+        as in Orthogroup.cache_save(), so the new entry replaces it in a single rename. Failure to
+        write the cache is reported but is not fatal
+
+        :param key: string      cache key
+        :param arrays: dict     {name: np.ndarray}, saved as <name>.npy
+        :param meta: dict       additional JSON serializable metadata
+        :param keep: list       keys of other entries that are not evicted, e.g., the entry that
+                                this one was derived from
+        :return: bool           True if the entry was written
+        -----------------------------------------------------------------------------------------"""
+        entrydir = os.path.join(self.cachedir, key)
+        tmpdir = f'{entrydir}.tmp{os.getpid()}'
+        meta = dict(meta or {}, arrays=list(arrays))
+        try:
+            os.makedirs(tmpdir, exist_ok=True)
+            for name in arrays:
+                np.save(os.path.join(tmpdir, f'{name}.npy'), arrays[name])
+            with open(os.path.join(tmpdir, 'meta.json'), 'w') as fh:
+                json.dump(meta, fh)
+
+            if os.path.isdir(entrydir):
+                # open memory maps of the old files stay valid after they are removed
+                olddir = f'{entrydir}.old{os.getpid()}'
+                os.rename(entrydir, olddir)
+                shutil.rmtree(olddir, ignore_errors=True)
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            sys.stderr.write(f'ResultCache.save() - cannot write cache ({entrydir})\n')
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return False
+
+        self.evict(keep=[key, *keep])
+        return True
+
+    def entries(self):
+        """-----------------------------------------------------------------------------------------
+        Complete entries in the cache, least recently used first
+
+        :return: list       [(last use in ns, size in bytes, key), ...]
+        -----------------------------------------------------------------------------------------"""
+        found = []
+        if not os.path.isdir(self.cachedir):
+            return found
+
+        for entry in os.scandir(self.cachedir):
+            metafile = os.path.join(entry.path, 'meta.json')
+            if not entry.is_dir() or '.tmp' in entry.name or '.old' in entry.name \
+                    or not os.path.exists(metafile):
+                # incomplete entries are being written, old entries are being removed
+                continue
+
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            found.append((os.stat(metafile).st_mtime_ns, size, entry.name))
+
+        return sorted(found)
+
+    def evict(self, keep=()):
+        """-----------------------------------------------------------------------------------------
+        Remove least recently used entries until the total size is no more than self.limit. The
+        entries in keep (usually the one just written) are not removed
+
+        :param keep: list       keys of entries that are not removed
+        :return: int            number of entries removed
+        -----------------------------------------------------------------------------------------"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        n_removed = 0
+        for _, size, key in entries:
+            if total <= self.limit:
+                break
+            if key in keep:
+                continue
+
+            shutil.rmtree(os.path.join(self.cachedir, key), ignore_errors=True)
+            total -= size
+            n_removed += 1
+
+        return n_removed
+
+    def json_read(self, *path):
+        """-----------------------------------------------------------------------------------------
+        :param path: strings    path of a JSON file relative to the cache directory
+        :return: object         contents of the file, None if it does not exist or is not valid
+        -----------------------------------------------------------------------------------------"""
+        try:
+            with open(os.path.join(self.cachedir, *path), 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+
+# --------------------------------------------------------------------------------------------------
+# Testing
+# --------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        datafile = os.path.join(tmp, 'Orthogroups.tsv')
+        with open(datafile, 'w') as out:
+            out.write('Orthogroup\ta.aa\tb.aa\nOG0000000\tx1, x2\ty1\n')
+
+        # each entry is about 1 kB, the limit holds two
+        cache = ResultCache(os.path.join(tmp, 'cache'), limit=2500)
+        keys = [cache.key(datafile, fraction=f) for f in (0.1, 0.2, 0.3)]
+        for k in keys:
+            cache.save(k, {'z': np.arange(100, dtype=np.float64)})
+            print(f'saved {k}\tentries:{len(cache.entries())}')
+
+        print(f'oldest evicted: {cache.load(keys[0]) is None}')
+        print(f'newest loaded: {cache.load(keys[2])["z"].sum()}')
+
+        # replacing an entry does not invalidate arrays that are already memory mapped, and a kept
+        # entry is not evicted even if it is the least recently used
+        z = cache.load(keys[2])['z']
+        cache.save(keys[2], {'z': np.ones(100)})
+        print(f'replaced: {cache.load(keys[2])["z"].sum()}  old map: {z.sum()}')
+        cache.save(keys[0], {'z': np.zeros(100)}, keep=[keys[1]])
+        print(f'kept: {cache.load(keys[1]) is not None}  evicted: {cache.load(keys[2]) is None}  '
+              f'entries: {sorted(os.listdir(cache.cachedir))}')
+
+    exit(0)
@@ -5,6 +5,10 @@ map orthogroups from to runs of orthofinder to each other
 
 Michael Gribskov     01 April 2024
 ================================================================================================="""
+import os
+
+from orthogroups import Orthogroup, SequenceIndex
+
 
 # --------------------------------------------------------------------------------------------------
 #
@@ -12,61 +16,56 @@ Michael Gribskov     01 April 2024
 if __name__ == '__main__':
     old_og_file = 'feb22_orthogroups.tsv'
     new_og_file = "mar31_orthogroups.tsv"
+    old_idx_file = old_og_file + '.index.npz'
 
     # read the old orthogroups and make an index where the key is a sequence name and the value is
-    # the old orthogroup
-    old = open(old_og_file, 'r')
-    header = old.readline()
+    # the old orthogroup. the orthogroups are streamed, only the index is kept in memory. The index
+    # is saved and reused as long as it is newer than the old orthogroups file
+    if os.path.exists(old_idx_file) and os.path.getmtime(old_idx_file) >= os.path.getmtime(old_og_file):
+        old_idx = SequenceIndex.load(old_idx_file)
+        print(f'{len(old_idx)} sequences read from {len(old_idx.name)} orthogroups ({old_idx_file})')
 
-    old_idx = {}
-    og_n = 0
-    seq_n = 0
-    for line in old:
-        og_n += 1
-        # print(line)
-        field = line.rstrip().split('\t')
+    else:
+        old = Orthogroup(old_og_file)
+        old.proteome_read()
 
-        og = field[0]
-        for sequence_list in field[1:]:
-            if not sequence_list:
-                continue
-            for sequence in sequence_list.split(','):
-                seq_n += 1
-                old_idx[sequence] = og
+        old_idx = SequenceIndex()
+        for record in old.iter_groups():
+            old_idx.add(record.members, record.name)
+        old_idx.finish()
+        old_idx.save(old_idx_file)
 
-    print(f'{seq_n} sequences read from {og_n} orthogroups')
-    old.close()
+        print(f'{len(old_idx)} sequences read from {len(old_idx.name)} orthogroups')
+        old.fh.close()
 
     # for each new orthogroup, read in the list of sequences and see what their former group was
 
-    new = open(new_og_file, 'r')
-    header = new.readline()
+    new = Orthogroup(new_og_file)
+    new.proteome_read()
 
     og_n = 0
     seq_n = 0
     og_count = {}
-    for line in new:
+    for record in new.iter_groups():
         og_n += 1
-        field = line.rstrip().split('\t')
-
-        og = field[0]
+        og = record.name
         og_count[og] = {'all': 0, 'unknown': 0}
 
-        for sequence_list in field[1:]:
-            if not sequence_list:
+        sequences = [sequence for sequence_list in record.members for sequence in sequence_list]
+        seq_n += len(sequences)
+        og_count[og]['all'] += len(sequences)
+        old_og, old_species = old_idx.lookup_many(sequences)
+        for g in old_og.tolist():
+            if g < 0:
+                og_count[og]['unknown'] += 1
                 continue
-            for sequence in sequence_list.split(','):
-                seq_n += 1
-                og_count[og]['all'] += 1
-                try:
-                    og_old = old_idx[sequence]
-                    if og_old in og_count[og]:
-                        og_count[og][og_old] += 1
-                    else:
-                        og_count[og][og_old] = 1
-                except KeyError:
-                    og_count[og]['unknown'] += 1
-    new.close()
+
+            og_old = old_idx.name[g]
+            if og_old in og_count[og]:
+                og_count[og][og_old] += 1
+            else:
+                og_count[og][og_old] = 1
+    new.fh.close()
 
     # result
     out = open('og.map.out', 'w')
@@ -0,0 +1,569 @@
+"""=================================================================================================
+orthogroups:og_server.py
+
+Query server for interactive target comparisons. The server reads the orthogroups and normalizes
+the counts once (as outliers.py does), then answers queries over localhost HTTP with JSON. The
+client subcommands use the same options as outliers.py, and rank writes the same text report and
+JSON files
+
+usage
+    python og_server.py serve -g Orthogroups.tsv -f 0.5 &
+    python og_server.py rank -t Cap6580,Delst1 -n 20 -j cold.json
+    python og_server.py rank -b sets.txt -T -j outliers.json
+    python og_server.py members 698 4039
+    python og_server.py counts 698
+
+HTTP interface, GET requests with JSON responses
+    /info                           proteomes, number of orthogroups, normalization parameters
+    /rank?target=Cap6580,Delst1&target=Horwer1,Myrdu1&ntop=20&members=all&tests=0&pseudocount=1.0
+                                    [{'result': outliers.py JSON, 'text': outliers.py report}, ...]
+                                    one for each target set; all the sets are ranked together, as
+                                    in an outliers.py --batch run
+    /members?og=698,4039            {og_num: [[organism, count, seq, ...], ...]}
+    /counts?og=698,4039             {og_num: [count, ...]}
+errors have status 400 (bad query) or 404 (unknown request) and the body {'error': message}
+
+18 October 2026
+================================================================================================="""
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from json_custom_encoder import CompactJSONEncoder
+from og_cache import ResultCache
+from og_stats import extremes, normalize, target_tests
+from orthogroups import FetchedGroups, Orthogroup
+from outliers import group_report, json_name, target_means, target_sets_read, trimmed_ave_std
+
+
+def process_command_line():
+    """---------------------------------------------------------------------------------------------
+    subcommands: serve starts the server, rank, members, and counts are queries
+
+    :return: argparse.Namespace     options, opt.command is the subcommand
+    ---------------------------------------------------------------------------------------------"""
+    formatter = lambda prog: argparse.HelpFormatter(prog, width=120, max_help_position=40)
+    cl = argparse.ArgumentParser(
+        description='Orthogroup query server and client',
+        formatter_class=formatter
+        )
+    command = cl.add_subparsers(dest='command', required=True)
+
+    # server, the options for reading and normalizing are the same as outliers.py
+    serve = command.add_parser('serve', help='read the orthogroups and answer queries',
+                               formatter_class=formatter)
+    serve.add_argument('-g', '--orthogroup',
+                       help='Orthogroups.tsv file',
+                       type=str,
+                       default='Orthogroups.tsv')
+
+    serve.add_argument('-f', '--fraction',
+                       help='total fraction of observations to trim in mean/std.dev. calculation',
+                       type=float,
+                       default=0.5)
+
+    serve.add_argument('-s', '--storage',
+                       help='orthogroup membership storage: list, csr (compact), or lazy (memory mapped)',
+                       type=str,
+                       choices=['list', 'csr', 'lazy'],
+                       default='list')
+
+    serve.add_argument('-c', '--cache',
+                       help='save/reuse parsed orthogroups in a binary cache next to ORTHOGROUP (implies csr)',
+                       action='store_true',
+                       default=False)
+
+    serve.add_argument('-w', '--workers',
+                       help='number of processes used to read ORTHOGROUP',
+                       type=int,
+                       default=1)
+
+    serve.add_argument('-m', '--members',
+                       help='load member sequences for all organisms, or none (members of the reported '
+                            'groups are read from ORTHOGROUP for each query)',
+                       type=str,
+                       choices=['all', 'none'],
+                       default='all')
+
+    serve.add_argument('-G', '--genecount',
+                       help='Orthogroups.GeneCount.tsv file, counts are read from this file and member '
+                            'sequences from ORTHOGROUP only for the reported groups',
+                       type=str,
+                       default='')
+
+    serve.add_argument('-z', '--ignore_zero',
+                       help='omit zero counts from the trimmed mean/std.dev. calculation',
+                       action='store_true',
+                       default=False)
+
+    serve.add_argument('-M', '--method',
+                       help='row normalization: trimmed mean/std.dev., or median/MAD (robust)',
+                       type=str,
+                       choices=['trimmed', 'mad'],
+                       default='trimmed')
+
+    serve.add_argument('-l', '--log1p',
+                       help='normalize log(1 + count) instead of count',
+                       action='store_true',
+                       default=False)
+
+    serve.add_argument('-C', '--result_cache',
+                       help='directory for cached counts and normalized z (see outliers.py)',
+                       type=str,
+                       default='')
+
+    serve.add_argument('-L', '--cache_limit',
+                       help='size limit of RESULT_CACHE in MB, least recently used results are removed',
+                       type=float,
+                       default=1024)
+
+    # client queries, the options for ranking are the same as outliers.py
+    rank = command.add_parser('rank', help='most reduced and expanded orthogroups of target sets',
+                              formatter_class=formatter)
+    rank.add_argument('-t', '--target',
+                      help='comma delimited string with list of target organisms',
+                      type=str,
+                      default='')
+
+    rank.add_argument('-b', '--batch',
+                      help='file of named target sets, one per line: name and comma delimited list of '
+                           'target organisms; replaces --target',
+                      type=str,
+                      default='')
+
+    rank.add_argument('-n', '--ntop',
+                      help='number of top/bottom groups to report',
+                      type=int,
+                      default=20)
+
+    rank.add_argument('-j', '--json',
+                      help='JSON output file',
+                      type=str,
+                      default='')
+
+    rank.add_argument('-m', '--members',
+                      help='report member sequences (all), or only counts (none)',
+                      type=str,
+                      choices=['all', 'none'],
+                      default='all')
+
+    rank.add_argument('-T', '--tests',
+                      help='two sample tests of target vs. other organism counts: Welch t, Mann-Whitney U, '
+                           'and log2 fold change',
+                      action='store_true',
+                      default=False)
+
+    rank.add_argument('-P', '--pseudocount',
+                      help='pseudocount added to the mean counts for log2 fold change',
+                      type=float,
+                      default=1.0)
+
+    for name, text in (('members', 'member sequences of orthogroups'),
+                       ('counts', 'sequence counts of each organism in orthogroups')):
+        groups = command.add_parser(name, help=text, formatter_class=formatter)
+        groups.add_argument('og', help='orthogroup numbers', type=int, nargs='+')
+
+    for parser in (serve, rank, command.choices['members'], command.choices['counts']):
+        parser.add_argument('-H', '--host',
+                            help='server address, use a local address',
+                            type=str,
+                            default='127.0.0.1')
+
+        parser.add_argument('-o', '--port',
+                            help='server port',
+                            type=int,
+                            default=8765)
+
+    serve.add_argument('-F', '--fetch_limit',
+                       help='maximum number of orthogroups whose members are kept after they are read '
+                            'from ORTHOGROUP, least recently used are removed',
+                       type=int,
+                       default=100000)
+
+    serve.add_argument('-K', '--test_limit',
+                       help='number of target sets whose two sample test statistics are kept in memory',
+                       type=int,
+                       default=16)
+
+    return cl.parse_args()
+
+
+class OrthogroupData:
+    """=============================================================================================
+    Orthogroups and normalized counts held by the server. Ranking only reads the z matrix and the
+    counts; reports that read members (og.group) are serialized by self.lock because fetched
+    members are added to og.fetched. og.fetched keeps at most fetch_limit orthogroups, the least
+    recently used are removed
+
+    The two sample test statistics of each target set are calculated once and kept for the
+    test_limit most recently used sets, and in the result cache if there is one; saving them does
+    not evict the cached counts and z
+    ============================================================================================="""
+
+    def __init__(self, opt):
+        """-----------------------------------------------------------------------------------------
+        Read and normalize the orthogroups in the same way as outliers.py
+
+        :param opt: argparse.Namespace      serve options
+        -----------------------------------------------------------------------------------------"""
+        self.filename = os.path.abspath(opt.orthogroup)
+        self.params = {'fraction': opt.fraction, 'method': opt.method,
+                       'ignore_zero': opt.ignore_zero, 'log1p': opt.log1p}
+        self.lock = threading.Lock()
+        self.fetch_limit = opt.fetch_limit
+        self.test_limit = opt.test_limit
+        self.tests = OrderedDict()
+
+        og = Orthogroup(opt.orthogroup, storage=opt.storage, cache=opt.cache, workers=opt.workers)
+        og.proteome_read()
+
+        result_cache = None
+        cache_key = None
+        cached = None
+        if opt.result_cache:
+            result_cache = ResultCache(opt.result_cache, limit=int(opt.cache_limit * (1 << 20)))
+            cache_key = result_cache.key(opt.orthogroup, method=opt.method,
+                                         ignore_zero=opt.ignore_zero, log1p=opt.log1p,
+                                         fraction=opt.fraction if opt.method == 'trimmed' else None)
+            cached = result_cache.load(cache_key)
+
+        if cached:
+            og.counts = cached['counts']
+            og.storage = 'fetch'
+            og.group = FetchedGroups(og)
+            self.z = cached['z']
+        else:
+            if opt.genecount:
+                og.genecount_read(opt.genecount)
+            elif opt.members == 'none' and not opt.cache:
+                og.counts_read()
+            else:
+                og.groups_read()
+
+            ave, std = trimmed_ave_std(og.counts, opt.fraction, ignore_zero=opt.ignore_zero,
+                                       method=opt.method, log1p=opt.log1p)
+            self.z = normalize(og.counts, ave, std, log1p=opt.log1p)
+            if result_cache:
+                result_cache.save(cache_key, {'counts': og.counts, 'z': self.z, 'ave': ave, 'std': std},
+                                  {'orthogroups': self.filename, 'proteome': og.proteome})
+
+        self.og = og
+        self.result_cache = result_cache
+        self.cache_key = cache_key
+        self.orgidx = [proteome.split('_')[0] for proteome in og.proteome]
+        self.organism = {name: p for p, name in enumerate(self.orgidx)}
+        self.source_data = dict(zip(self.orgidx, og.proteome))
+
+    def info(self):
+        """-----------------------------------------------------------------------------------------
+        :return: dict       source data, number of orthogroups, and normalization parameters
+        -----------------------------------------------------------------------------------------"""
+        return {'orthogroups': self.filename, 'n_groups': len(self.z),
+                'source_data': self.source_data, 'normalization': self.params}
+
+    def rank(self, target_sets, ntop=20, counts_only=False, tests=False, pseudocount=1.0):
+        """-----------------------------------------------------------------------------------------
+        Most reduced and expanded orthogroups of each target set, as reported by outliers.py. The
+        mean target z of each set is calculated as in outliers.py (target_means()), so the results
+        (including the order of ties) are the same as a batch run with the same sets
+
+        :param target_sets: list    list of target organisms for each set
+        :param ntop: int            number of top/bottom groups to report
+        :param counts_only: bool    if True, report counts without the member sequences
+        :param tests: bool          add Welch t, Mann-Whitney U, and log2 fold change
+        :param pseudocount: float   pseudocount for log2 fold change
+        :return: list of dict       [{'result': outliers.py JSON, 'text': outliers.py report}, ...]
+        -----------------------------------------------------------------------------------------"""
+        if not target_sets:
+            raise ValueError('no target')
+        for target in target_sets:
+            unknown = [t for t in target if t not in self.organism]
+            if not target or unknown:
+                raise ValueError(f'unknown organism ({",".join(unknown)})' if unknown else 'no target')
+
+        og = self.og
+        target_cols = [[self.organism[t] for t in target] for target in target_sets]
+        set_z = target_means(self.z, target_cols)
+        ranking = [extremes(set_z[:, s], ntop) for s in range(len(target_sets))]
+        reported = [g for bottom, top in ranking for g in bottom.tolist() + top.tolist()]
+
+        report = []
+        for s, target in enumerate(target_sets):
+            stats = {}
+            if tests:
+                stats = self.test_stats(sorted(set(target_cols[s])), pseudocount)
+
+            json_out = {'source_data': self.source_data}
+            if counts_only:
+                json_out['orthogroups'] = self.filename
+            report.append((target, stats, json_out))
+
+        response = []
+        with self.lock:
+            if og.storage == 'fetch' and not counts_only:
+                og.members_fetch(reported)
+
+            for s, (target, stats, json_out) in enumerate(report):
+                bottom, top = ranking[s]
+                selected = set_z[:, s]
+                text = io.StringIO()
+                print(f'\n{ntop} most reduced in {target}', file=text)
+                json_out['Reduced'] = group_report(og, self.orgidx, selected, bottom.tolist(),
+                                                   stats=stats, counts_only=counts_only, out=text)
+                print(f'\n{ntop} most expanded in {target}', file=text)
+                json_out['Expanded'] = group_report(og, self.orgidx, selected, top.tolist(),
+                                                    blank=True, stats=stats,
+                                                    counts_only=counts_only, out=text)
+                response.append({'result': json_out, 'text': text.getvalue()})
+
+            self.fetched_trim(reported)
+
+        return response
+
+    def test_stats(self, cols, pseudocount):
+        """-----------------------------------------------------------------------------------------
+        Two sample test statistics (og_stats.target_tests()) of one target set, from memory, the
+        result cache, or calculated and saved in both
+
+        :param cols: list           sorted column indices of the target organisms
+        :param pseudocount: float   pseudocount for log2 fold change
+        :return: dict               {name: np.ndarray}, value of each statistic for each orthogroup
+        -----------------------------------------------------------------------------------------"""
+        key = (tuple(cols), pseudocount)
+        with self.lock:
+            if key in self.tests:
+                self.tests.move_to_end(key)
+                return self.tests[key]
+
+        stats = None
+        result_cache = self.result_cache
+        if result_cache:
+            cache_key = result_cache.key(self.filename, tests=cols, pseudocount=pseudocount)
+            cached = result_cache.load(cache_key)
+            if cached:
+                stats = {name: cached[name] for name in cached['meta']['arrays']}
+
+        if stats is None:
+            stats = target_tests(self.og.counts, cols, pseudocount=pseudocount)
+            if result_cache:
+                # the test statistics do not evict the counts and z that the server uses
+                result_cache.save(cache_key, stats, {'orthogroups': self.filename, 'cols': cols},
+                                  keep=[self.cache_key])
+
+        with self.lock:
+            self.tests[key] = stats
+            while len(self.tests) > self.test_limit:
+                self.tests.popitem(last=False)
+
+        return stats
+
+    def fetched_trim(self, groups):
+        """-----------------------------------------------------------------------------------------
+        Mark the fetched members of groups as the most recently used and remove the least recently
+        used rows from og.fetched so that no more than self.fetch_limit are kept. Call with
+        self.lock held
+
+        :param groups: list     orthogroup numbers that were used
+        :return: int            number of rows removed
+        -----------------------------------------------------------------------------------------"""
+        fetched = self.og.fetched
+        for g in groups:
+            if g in fetched:
+                fetched[g] = fetched.pop(g)
+
+        n_remove = max(0, len(fetched) - self.fetch_limit)
+        for g in list(itertools.islice(fetched, n_remove)):
+            del fetched[g]
+
+        return n_remove
+
+    def members(self, groups):
+        """-----------------------------------------------------------------------------------------
+        :param groups: list     orthogroup numbers
+        :return: dict           {og_num: [[organism, count, seq, ...], ...]}
+        -----------------------------------------------------------------------------------------"""
+        self.check_groups(groups)
+        og = self.og
+        result = {}
+        with self.lock:
+            if og.storage == 'fetch':
+                og.members_fetch(groups)
+            for g in groups:
+                row = og.group[g]
+                result[g] = [[self.orgidx[i], len(row[i])] + row[i] for i in range(len(row))]
+            self.fetched_trim(groups)
+
+        return result
+
+    def counts(self, groups):
+        """-----------------------------------------------------------------------------------------
+        :param groups: list     orthogroup numbers
+        :return: dict           {og_num: [count, ...]}, counts follow source_data
+        -----------------------------------------------------------------------------------------"""
+        self.check_groups(groups)
+        return {g: self.og.count_row(g).tolist() for g in groups}
+
+    def check_groups(self, groups):
+        """-----------------------------------------------------------------------------------------
+        :param groups: list     orthogroup numbers
+        :return: None           raises ValueError if a group does not exist
+        -----------------------------------------------------------------------------------------"""
+        bad = [str(g) for g in groups if not 0 <= g < len(self.z)]
+        if not groups or bad:
+            raise ValueError(f'unknown orthogroup ({",".join(bad)})' if bad else 'no orthogroup')
+
+        return None
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """=============================================================================================
+    HTTP requests for the OrthogroupData in self.server.data, see the module documentation for
+    the requests and their parameters
+    ============================================================================================="""
+
+    def do_GET(self):
+        """-----------------------------------------------------------------------------------------
+        :return: None
+        -----------------------------------------------------------------------------------------"""
+        url = urllib.parse.urlsplit(self.path)
+        values = urllib.parse.parse_qs(url.query)
+        query = {k: v[-1] for k, v in values.items()}
+        data = self.server.data
+        try:
+            if url.path == '/info':
+                response = data.info()
+            elif url.path == '/rank':
+                response = data.rank([[t for t in target.split(',') if t]
+                                      for target in values.get('target', [])],
+                                     ntop=int(query.get('ntop', 20)),
+                                     counts_only=query.get('members', 'all') == 'none',
+                                     tests=query.get('tests', '0') == '1',
+                                     pseudocount=float(query.get('pseudocount', 1.0)))
+            elif url.path in ('/members', '/counts'):
+                groups = [int(g) for g in query.get('og', '').split(',') if g]
+                response = getattr(data, url.path[1:])(groups)
+            else:
+                self.reply(404, {'error': f'unknown request ({url.path})'})
+                return None
+        except ValueError as err:
+            self.reply(400, {'error': str(err)})
+            return None
+
+        self.reply(200, response)
+        return None
+
+    def reply(self, status, response):
+        """-----------------------------------------------------------------------------------------
+        :param status: int          HTTP status
+        :param response: dict       response, sent as JSON
+        :return: None
+        -----------------------------------------------------------------------------------------"""
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        return None
+
+
+def serve(opt):
+    """---------------------------------------------------------------------------------------------
+    Read the orthogroups and answer queries until interrupted
+
+    :param opt: argparse.Namespace      serve options
+    :return: None
+    ---------------------------------------------------------------------------------------------"""
+    sys.stderr.write(f'Orthogroups: {opt.orthogroup}\n')
+    data = OrthogroupData(opt)
+    sys.stderr.write(f'{len(data.z)} orthogroups, {len(data.orgidx)} proteomes\n')
+
+    try:
+        server = ThreadingHTTPServer((opt.host, opt.port), QueryHandler)
+    except OSError as err:
+        sys.stderr.write(f'og_server - unable to start server on {opt.host}:{opt.port} ({err})\n')
+        exit(2)
+
+    server.data = data
+    sys.stderr.write(f'Serving on http://{opt.host}:{opt.port}\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+    return None
+
+
+def query(opt, request, **params):
+    """---------------------------------------------------------------------------------------------
+    Send a query to the server, exit with a message if it fails
+
+    :param opt: argparse.Namespace      client options (host and port)
+    :param request: string              request, e.g., 'rank'
+    :param params: dict                 query parameters
+    :return: dict                       response
+    ---------------------------------------------------------------------------------------------"""
+    url = f'http://{opt.host}:{opt.port}/{request}?{urllib.parse.urlencode(params, doseq=True)}'
+    try:
+        with urllib.request.urlopen(url) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as err:
+        sys.stderr.write(f'og_server - {json.load(err).get("error", err.reason)}\n')
+        exit(2)
+    except urllib.error.URLError as err:
+        sys.stderr.write(f'og_server - unable to connect to server ({url}): {err.reason}\n')
+        exit(1)
+
+
+# ==================================================================================================
+# Main
+# ==================================================================================================
+if __name__ == '__main__':
+    opt = process_command_line()
+
+    if opt.command == 'serve':
+        serve(opt)
+
+    elif opt.command == 'rank':
+        if opt.batch:
+            target_sets = target_sets_read(opt.batch)
+        else:
+            target_sets = {opt.target: opt.target.split(',')}
+
+        source_data = query(opt, 'info')['source_data']
+        print('Source Data:')
+        for name in source_data:
+            print(f'{name}\t{source_data[name]}')
+
+        # all sets are ranked in one request, as in an outliers.py batch run
+        print('\nExpanded/contracted Groups:')
+        responses = query(opt, 'rank', target=[','.join(target_sets[name]) for name in target_sets],
+                          ntop=opt.ntop, members=opt.members, tests=int(opt.tests),
+                          pseudocount=opt.pseudocount)
+        for name, response in zip(target_sets, responses):
+            if opt.batch:
+                print(f'\nTarget set {name}')
+            print(response['text'], end='')
+
+            if opt.json:
+                jsonfile = open(json_name(opt.json, name, opt.batch), 'w')
+                json.dump(response['result'], jsonfile, indent=2, cls=CompactJSONEncoder)
+                jsonfile.write('\n')
+                jsonfile.close()
+
+    else:
+        response = query(opt, opt.command, og=','.join(str(g) for g in opt.og))
+        print(json.dumps(response, indent=2, cls=CompactJSONEncoder))
+
+    exit(0)
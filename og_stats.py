@@ -0,0 +1,793 @@
+"""=================================================================================================
+orthogroups:og_stats.py
+
+Vectorized row-wise statistics for orthogroup count matrices (rows are orthogroups, columns are
+proteomes). Each function works on whole blocks of rows with numpy array operations; there are no
+per-row python loops
+
+trimmed mean and standard deviation follow scipy.stats.mstats.trimmed_mean/trimmed_std with
+limits=(proportion/2, proportion/2) and inclusive=(False, False): for a row of n values,
+round(n * proportion/2) values are removed from each end (round half to even, as np.round). With
+ignore_zero, n is the number of non-zero values in each row and the zeroes are not used
+
+two sample tests (Welch t, Mann-Whitney U, log2 fold change) compare the target columns to the
+other columns of every row at once. p-values use the vectorized distribution functions in
+scipy.special; without scipy the statistics are calculated but the p-values are NaN
+
+data may also be a scipy.sparse matrix; it is expanded to a dense array one block of rows at a time
+(dense_rows())
+
+the row statistics and normalize() take log1p=True to work on log(1 + count); the transform is
+applied to each block as it is expanded. log1p is monotonic and maps 0 to 0, so sorted rows stay
+sorted and the zeroes are the same
+
+median_mad() is a robust alternative to the trimmed mean and standard deviation: the median and the
+median absolute deviation scaled by 1.4826 (the standard deviation for normal data)
+
+18 October 2026
+================================================================================================="""
+import itertools
+import math
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+try:
+    from scipy import special
+except ImportError:
+    special = None
+
+
+def dense_rows(data, begin, end, dtype=np.float64, log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Rows begin:end of a dense array or scipy.sparse matrix as a dense array
+
+    :param data: np.ndarray or scipy.sparse matrix      2D, rows are orthogroups
+    :param begin: int           first row
+    :param end: int             last row + 1
+    :param dtype: np.dtype      type of the result
+    :param log1p: bool          if True, return log(1 + value)
+    :return: np.ndarray         2D dense rows
+    ---------------------------------------------------------------------------------------------"""
+    block = data[begin:end]
+    if hasattr(block, 'toarray'):
+        block = block.toarray()
+
+    if log1p:
+        return np.log1p(block, dtype=dtype)
+
+    return np.asarray(block, dtype=dtype)
+
+
+def trim_bounds(n, proportion):
+    """---------------------------------------------------------------------------------------------
+    Indices of the first value kept and the value after the last kept value in a sorted row of n
+    values. n may be an int or an array of ints
+
+    :param n: int or np.ndarray     number of values in row
+    :param proportion: float        total fraction to trim, proportion/2 on each side
+    :return: int, int               low (inclusive) and high (exclusive) index
+    ---------------------------------------------------------------------------------------------"""
+    cut = np.round(np.asarray(n) * (proportion / 2)).astype(np.int64)
+    low = cut
+    high = n - cut
+
+    if np.ndim(low) == 0:
+        return int(low), int(high)
+
+    return low, high
+
+
+def trimmed_mean_std(data, proportion, ignore_zero=False, dtype=np.float64, chunk=1 << 16,
+                     log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Row-wise trimmed mean and (population, ddof=0) standard deviation. The rows are processed in
+    blocks of chunk rows so temporary arrays are bounded
+
+    The arithmetic is the same as scipy.stats.mstats: the trimmed values are found with np.argsort
+    and set to zero, and the sums are over the full rows in column order, so the results are
+    identical to trimmed_mean()/trimmed_std(), not just equal within rounding. The ranking of
+    groups with tied z therefore does not depend on which calculation was used
+
+    if ignore_zero is True, see trimmed_mean_std_nonzero()
+
+    :param data: np.ndarray     2D count matrix, rows are orthogroups
+    :param proportion: float    total fraction to trim, proportion/2 on each side
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param dtype: np.dtype      float type for the calculation and result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param log1p: bool          if True, use log(1 + value)
+    :return: np.ndarray, np.ndarray     trimmed mean and standard deviation of each row
+    ---------------------------------------------------------------------------------------------"""
+    if ignore_zero:
+        return trimmed_mean_std_nonzero(data, proportion, dtype=dtype, chunk=chunk, log1p=log1p)
+
+    nrow, ncol = data.shape
+    ave = np.empty(nrow, dtype=dtype)
+    std = np.empty(nrow, dtype=dtype)
+
+    low, high = trim_bounds(ncol, proportion)
+    if high <= low:
+        # everything is trimmed
+        ave[:] = np.nan
+        std[:] = np.nan
+        return ave, std
+
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = dense_rows(data, begin, end, dtype=dtype, log1p=log1p)
+        kept = np.zeros(block.shape, dtype=bool)
+        np.put_along_axis(kept, np.argsort(block, axis=1)[:, low:high], True, axis=1)
+        mean = np.where(kept, block, 0).sum(axis=1) / (high - low)
+        deviation = np.where(kept, block - mean[:, None], 0)
+        ave[begin:end] = mean
+        std[begin:end] = np.sqrt((deviation * deviation).sum(axis=1) / (high - low))
+
+    return ave, std
+
+
+def trimmed_mean_std_nonzero(data, proportion, dtype=np.float64, chunk=1 << 16, log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Row-wise trimmed mean and standard deviation of the non-zero values (data must be
+    non-negative). Each row is trimmed according to its own number of non-zero values, n. After a
+    row is sorted the zeroes are at the beginning, so the non-zero values are the last n columns.
+    Rows with the same n have the same trim bounds, so they are processed together: the loop is
+    over the distinct values of n (at most the number of columns), not over rows.
+
+    Rows with no non-zero values (or with everything trimmed) have a mean and standard deviation of
+    NaN
+
+    :param data: np.ndarray     2D count matrix, rows are orthogroups
+    :param proportion: float    total fraction to trim, proportion/2 on each side
+    :param dtype: np.dtype      float type for the calculation and result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param log1p: bool          if True, use log(1 + value)
+    :return: np.ndarray, np.ndarray     trimmed mean and standard deviation of each row
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = data.shape
+    ave = np.full(nrow, np.nan, dtype=dtype)
+    std = np.full(nrow, np.nan, dtype=dtype)
+
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = np.sort(dense_rows(data, begin, end, dtype=dtype, log1p=log1p), axis=1)
+        nonzero = np.count_nonzero(block, axis=1)
+
+        for n in np.unique(nonzero).tolist():
+            low, high = trim_bounds(n, proportion)
+            if high <= low:
+                continue
+
+            row = np.flatnonzero(nonzero == n)
+            kept = block[row, ncol - n + low:ncol - n + high]
+            ave[begin + row] = kept.mean(axis=1)
+            std[begin + row] = kept.std(axis=1)
+
+    return ave, std
+
+
+def median_mad(data, ignore_zero=False, dtype=np.float64, chunk=1 << 16, log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Row-wise median and scaled median absolute deviation (MAD), a robust location and scale for
+    heavy tailed rows. Each block of rows is sorted once, see sorted_median_mad()
+
+    :param data: np.ndarray     2D count matrix, rows are orthogroups
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param dtype: np.dtype      float type for the calculation and result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param log1p: bool          if True, use log(1 + value)
+    :return: np.ndarray, np.ndarray     median and scale of each row
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = data.shape
+    med = np.empty(nrow, dtype=dtype)
+    scale = np.empty(nrow, dtype=dtype)
+
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = np.sort(dense_rows(data, begin, end, dtype=dtype, log1p=log1p), axis=1)
+        if ignore_zero:
+            n = np.count_nonzero(block, axis=1)
+        else:
+            n = np.full(end - begin, ncol)
+        med[begin:end], scale[begin:end] = sorted_median_mad(block, n)
+
+    return med, scale
+
+
+def sorted_median_mad(block, n):
+    """---------------------------------------------------------------------------------------------
+    Median and scaled MAD of the last n[i] values of each sorted row i. The median is read from the
+    sorted row; the MAD is the median of the absolute deviations, found with np.partition. Rows with
+    the same n are processed together, so the loop is over the distinct values of n.
+
+    The scale is 1.4826 * MAD. Count data often have MAD = 0 (more than half the values equal the
+    median), then 1.2533 * the mean absolute deviation is used instead (also consistent with the
+    standard deviation for normal data); it is 0 only if all values are equal. Rows with n = 0 have
+    median and scale NaN
+
+    :param block: np.ndarray    2D, each row sorted ascending
+    :param n: np.ndarray        number of values used in each row
+    :return: np.ndarray, np.ndarray     median and scale of each row
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = block.shape
+    med = np.full(nrow, np.nan)
+    scale = np.full(nrow, np.nan)
+
+    for k in np.unique(n).tolist():
+        if k == 0:
+            continue
+
+        row = np.flatnonzero(n == k)
+        kept = block[row, ncol - k:]
+        mid = [(k - 1) // 2, k // 2]
+        center = kept[:, mid].mean(axis=1)
+        deviation = np.abs(kept - center[:, None])
+        mad = np.partition(deviation, mid, axis=1)[:, mid].mean(axis=1)
+        mean_ad = deviation.mean(axis=1)
+
+        med[row] = center
+        scale[row] = np.where(mad > 0, 1.4826 * mad, 1.2533 * mean_ad)
+
+    return med, scale
+
+
+def normalize(data, ave, std, dtype=np.float64, chunk=1 << 16, log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Convert each row to a standard normal deviate, (data - ave) / std, in blocks of chunk rows. With
+    log1p, (log(1 + data) - ave) / std
+
+    :param data: np.ndarray     2D count matrix, rows are orthogroups
+    :param ave: np.ndarray      mean of each row
+    :param std: np.ndarray      standard deviation of each row, must not be zero
+    :param dtype: np.dtype      float type of the result
+    :param chunk: int           number of rows per block
+    :param log1p: bool          if True, normalize log(1 + value)
+    :return: np.ndarray         normalized data
+    ---------------------------------------------------------------------------------------------"""
+    nrow = data.shape[0]
+    z = np.empty(data.shape, dtype=dtype)
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = dense_rows(data, begin, end, dtype=dtype, log1p=log1p)
+        z[begin:end] = (block - ave[begin:end, None]) / std[begin:end, None]
+
+    return z
+
+
+def extremes(values, n):
+    """---------------------------------------------------------------------------------------------
+    Indices of the n smallest and n largest values, found with np.partition so the cost is linear in
+    len(values); only the selected indices are sorted. Ties are broken by index, so the result is
+    the same as the first and last n of a stable ascending sort,
+        ranked = sorted(range(len(values)), key=lambda g: values[g])
+        ranked[:n], ranked[-n:]
+
+    :param values: np.ndarray   1D array, e.g., mean target z of each orthogroup
+    :param n: int               number of values to select at each end
+    :return: np.ndarray, np.ndarray     indices of the smallest and largest values, each in
+                                        ascending order of value (then index)
+    ---------------------------------------------------------------------------------------------"""
+    values = np.asarray(values)
+    size = len(values)
+    n = min(max(n, 0), size)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    if 2 * n >= size:
+        order = np.argsort(values, kind='stable')
+        return order[:n], order[size - n:]
+
+    # smallest: everything below the n-th value and the lowest indices of the values equal to it
+    threshold = np.partition(values, n - 1)[n - 1]
+    below = np.flatnonzero(values < threshold)
+    tied = np.flatnonzero(values == threshold)
+    bottom = np.concatenate((below, tied[:n - len(below)]))
+
+    # largest: everything above the n-th largest value and the highest indices of the values
+    # equal to it
+    threshold = np.partition(values, size - n)[size - n]
+    above = np.flatnonzero(values > threshold)
+    tied = np.flatnonzero(values == threshold)
+    top = np.concatenate((above, tied[len(tied) - (n - len(above)):]))
+
+    # np.lexsort sorts by the last key first
+    bottom = bottom[np.lexsort((bottom, values[bottom]))]
+    top = top[np.lexsort((top, values[top]))]
+
+    return bottom, top
+
+
+def bh_qvalues(p):
+    """---------------------------------------------------------------------------------------------
+    Benjamini-Hochberg FDR q-values, q(i) = min over j >= i of p(j) * m / j for p-values sorted
+    ascending, limited to 1
+
+    :param p: np.ndarray        p-values
+    :return: np.ndarray         q-values in the same order as p
+    ---------------------------------------------------------------------------------------------"""
+    p = np.asarray(p, dtype=np.float64)
+    m = len(p)
+    order = np.argsort(p, kind='stable')
+    q = p[order] * m / np.arange(1, m + 1)
+    q = np.minimum.accumulate(q[::-1])[::-1]
+
+    result = np.empty(m)
+    result[order] = np.minimum(q, 1.0)
+    return result
+
+
+def permutation_sets(ncol, k, n_perm, seed=None):
+    """---------------------------------------------------------------------------------------------
+    Column index sets for a permutation test of the mean of k of ncol columns. If there are no more
+    than n_perm distinct sets, all of them are returned and the test is exact; otherwise n_perm sets
+    of k columns are drawn without replacement
+
+    :param ncol: int            number of columns (proteomes)
+    :param k: int               number of columns in each set (target organisms)
+    :param n_perm: int          number of random sets
+    :param seed: int            random seed, None for a random seed
+    :return: np.ndarray, bool   column index sets (nset x k), True if all sets are enumerated
+    ---------------------------------------------------------------------------------------------"""
+    if math.comb(ncol, k) <= n_perm:
+        return np.array(list(itertools.combinations(range(ncol), k)), dtype=np.int64), True
+
+    rng = np.random.default_rng(seed)
+    return np.argsort(rng.random((n_perm, ncol)), axis=1)[:, :k], False
+
+
+def permutation_count(z, observed, sets, batch=256, chunk=1 << 14, tol=1e-10):
+    """---------------------------------------------------------------------------------------------
+    For each row, count the column sets whose mean z is <= and >= the observed mean. A batch of sets
+    is an indicator matrix, so the means of all the sets in the batch for a block of rows are a
+    single matrix product; temporary arrays are limited to chunk x batch
+
+    :param z: np.ndarray        normalized data, rows are orthogroups
+    :param observed: np.ndarray observed mean z of the target columns for each row
+    :param sets: np.ndarray     column index sets (nset x k), from permutation_sets()
+    :param batch: int           number of sets per matrix product
+    :param chunk: int           number of rows per block
+    :param tol: float           tolerance for equal means (summation order differs)
+    :return: np.ndarray, np.ndarray     counts of sets <= observed, >= observed
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = z.shape
+    k = sets.shape[1]
+    low = np.zeros(nrow, dtype=np.int64)
+    high = np.zeros(nrow, dtype=np.int64)
+
+    for sbegin in range(0, len(sets), batch):
+        part = sets[sbegin:sbegin + batch]
+        indicator = np.zeros((len(part), ncol))
+        np.put_along_axis(indicator, part, 1.0 / k, axis=1)
+        indicator = indicator.T
+
+        for begin in range(0, nrow, chunk):
+            end = min(begin + chunk, nrow)
+            mean = np.asarray(z[begin:end]) @ indicator
+            obs = observed[begin:end, None]
+            low[begin:end] += np.count_nonzero(mean <= obs + tol, axis=1)
+            high[begin:end] += np.count_nonzero(mean >= obs - tol, axis=1)
+
+    return low, high
+
+
+def permutation_range(shm_name, shape, begin, end, observed, sets):
+    """---------------------------------------------------------------------------------------------
+    Worker for permutation_test(), runs permutation_count() for rows begin:end of a z matrix in
+    shared memory
+
+    :param shm_name: string     name of the shared memory block holding z (float64)
+    :param shape: tuple         shape of z
+    :param begin: int           first row
+    :param end: int             last row + 1
+    :param observed: np.ndarray observed mean z for rows begin:end
+    :param sets: np.ndarray     column index sets
+    :return: np.ndarray, np.ndarray     counts of sets <= observed, >= observed
+    ---------------------------------------------------------------------------------------------"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    z = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    low, high = permutation_count(z[begin:end], observed, sets)
+
+    del z
+    shm.close()
+    return low, high
+
+
+def permutation_test(z, observed, k, n_perm, seed=None, workers=1):
+    """---------------------------------------------------------------------------------------------
+    Empirical p-values for the observed mean z of k target columns, compared to the mean z of k
+    columns chosen from all columns. The same column sets are used for every row. With workers > 1,
+    z is copied to shared memory once and the rows are divided among a process pool, so the result
+    does not depend on the number of workers
+
+    p_low is for contraction (mean <= observed), p_high for expansion (mean >= observed). For random
+    sets p = (count + 1) / (n_perm + 1); for an exact test the target set is one of the enumerated
+    sets and p = count / nset
+
+    :param z: np.ndarray        normalized data, rows are orthogroups
+    :param observed: np.ndarray observed mean z of the target columns for each row
+    :param k: int               number of target columns
+    :param n_perm: int          number of permutations
+    :param seed: int            random seed, None for a random seed
+    :param workers: int         number of processes
+    :return: np.ndarray, np.ndarray, bool   p_low, p_high, True if the test is exact
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = z.shape
+    sets, exact = permutation_sets(ncol, k, n_perm, seed)
+    observed = np.asarray(observed, dtype=np.float64)
+
+    if workers > 1 and nrow > workers:
+        shm = shared_memory.SharedMemory(create=True, size=max(z.size * 8, 1))
+        try:
+            shared = np.ndarray(z.shape, dtype=np.float64, buffer=shm.buf)
+            shared[:] = z
+            bounds = np.linspace(0, nrow, workers * 4 + 1).astype(np.int64).tolist()
+            with Pool(workers) as pool:
+                parts = pool.starmap(permutation_range,
+                                     [(shm.name, z.shape, begin, end, observed[begin:end], sets)
+                                      for begin, end in zip(bounds[:-1], bounds[1:])])
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+
+        low = np.concatenate([part[0] for part in parts])
+        high = np.concatenate([part[1] for part in parts])
+    else:
+        low, high = permutation_count(z, observed, sets)
+
+    if exact:
+        return low / len(sets), high / len(sets), exact
+
+    return (low + 1) / (len(sets) + 1), (high + 1) / (len(sets) + 1), exact
+
+
+def welch_t(a, b):
+    """---------------------------------------------------------------------------------------------
+    Row-wise Welch t-test of the columns of a against the columns of b. Both groups need at least two
+    columns for the sample variances. Rows where both groups are constant have t = 0 and p = 1 if the
+    means are equal, and t = +/-inf and p = 0 otherwise
+
+    :param a: np.ndarray        2D, target values, rows are orthogroups
+    :param b: np.ndarray        2D, other values, same number of rows as a
+    :return: np.ndarray, np.ndarray, np.ndarray     t, Welch-Satterthwaite degrees of freedom,
+                                                    two-sided p-value
+    ---------------------------------------------------------------------------------------------"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    na = a.shape[1]
+    nb = b.shape[1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        va = a.var(axis=1, ddof=1) / na
+        vb = b.var(axis=1, ddof=1) / nb
+        diff = a.mean(axis=1) - b.mean(axis=1)
+        se = np.sqrt(va + vb)
+        t = diff / se
+        df = (va + vb) ** 2 / (va * va / (na - 1) + vb * vb / (nb - 1))
+
+        constant = se == 0
+        t[constant & (diff == 0)] = 0
+        if special is None:
+            p = np.full(len(t), np.nan)
+        else:
+            p = 2 * special.stdtr(df, -np.abs(t))
+        p[constant] = np.where(diff[constant] == 0, 1.0, 0.0)
+
+    return t, df, p
+
+
+def mann_whitney_u(a, b, chunk=1 << 14):
+    """---------------------------------------------------------------------------------------------
+    Row-wise Mann-Whitney U of the columns of a against the columns of b. U is the number of (a, b)
+    pairs with a > b plus half the number of ties, which is the same as the rank sum of a minus
+    na(na+1)/2 with average ranks for ties. The two-sided p-value is the normal approximation with
+    tie and continuity corrections (scipy.stats.mannwhitneyu, method='asymptotic').
+
+    U is calculated from ranks: each row is sorted once, tied values get the average of their
+    ranks, and the tie correction comes from the lengths of the runs of equal values. Rows are
+    processed in blocks of at most chunk rows, and no more than 2^24 values per block, so memory
+    is proportional to the number of values in a block
+
+    :param a: np.ndarray        2D, target values, rows are orthogroups
+    :param b: np.ndarray        2D, other values, same number of rows as a
+    :param chunk: int           number of rows per block
+    :return: np.ndarray, np.ndarray     U of a, two-sided p-value
+    ---------------------------------------------------------------------------------------------"""
+    nrow, na = a.shape
+    nb = b.shape[1]
+    n = na + nb
+    u = np.empty(nrow)
+    tie = np.empty(nrow)
+    chunk = max(1, min(chunk, (1 << 24) // max(n, 1)))
+    position = np.arange(n)
+
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        both = np.concatenate((np.asarray(a[begin:end]), np.asarray(b[begin:end])), axis=1)
+        order = np.argsort(both, axis=1, kind='stable')
+        ordered = np.take_along_axis(both, order, axis=1)
+
+        # first and last sorted position of the run of equal values that holds each position
+        new_run = np.ones(ordered.shape, dtype=bool)
+        new_run[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+        run_end = np.ones(ordered.shape, dtype=bool)
+        run_end[:, :-1] = new_run[:, 1:]
+        first = np.maximum.accumulate(np.where(new_run, position, 0), axis=1)
+        last = np.minimum.accumulate(np.where(run_end, position, n)[:, ::-1], axis=1)[:, ::-1]
+
+        rank = np.empty(ordered.shape)
+        np.put_along_axis(rank, order, (first + last) / 2 + 1, axis=1)
+        u[begin:end] = rank[:, :na].sum(axis=1) - na * (na + 1) / 2
+
+        # each value in a run of t tied values contributes t^2 - 1, sum(t^3 - t) over the runs
+        t = (last - first + 1).astype(np.float64)
+        tie[begin:end] = (t * t - 1).sum(axis=1)
+
+    mu = na * nb / 2
+    sigma = np.sqrt(na * nb / 12 * ((n + 1) - tie / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zu = (np.abs(u - mu) - 0.5) / sigma
+
+    if special is None:
+        p = np.full(nrow, np.nan)
+    else:
+        p = np.minimum(2 * special.ndtr(-zu), 1.0)
+    # all values tied
+    p[sigma == 0] = 1.0
+
+    return u, p
+
+
+def log2_fold_change(a, b, pseudocount=1.0):
+    """---------------------------------------------------------------------------------------------
+    Row-wise log2 ratio of the mean of the columns of a to the mean of the columns of b, with a
+    pseudocount added to both means so that zero counts are defined
+
+    :param a: np.ndarray        2D, target values, rows are orthogroups
+    :param b: np.ndarray        2D, other values, same number of rows as a
+    :param pseudocount: float   added to each mean
+    :return: np.ndarray         log2((mean(a) + pseudocount) / (mean(b) + pseudocount))
+    ---------------------------------------------------------------------------------------------"""
+    return np.log2((np.asarray(a).mean(axis=1) + pseudocount) /
+                   (np.asarray(b).mean(axis=1) + pseudocount))
+
+
+def target_tests(data, cols, pseudocount=1.0, chunk=1 << 14):
+    """---------------------------------------------------------------------------------------------
+    Two sample tests of the target columns against all other columns for every row. Rows are
+    processed in blocks of chunk rows
+
+    :param data: np.ndarray     2D count matrix, rows are orthogroups
+    :param cols: list           column indices of the target organisms
+    :param pseudocount: float   pseudocount for log2 fold change
+    :param chunk: int           number of rows per block
+    :return: dict               np.ndarray for each statistic, keys t, t_p, U, U_p, log2fc
+    ---------------------------------------------------------------------------------------------"""
+    nrow, ncol = data.shape
+    other = np.setdiff1d(np.arange(ncol), cols)
+    result = {key: np.empty(nrow) for key in ('t', 't_p', 'U', 'U_p', 'log2fc')}
+
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = dense_rows(data, begin, end)
+        a = block[:, cols]
+        b = block[:, other]
+
+        result['t'][begin:end], _, result['t_p'][begin:end] = welch_t(a, b)
+        result['U'][begin:end], result['U_p'][begin:end] = mann_whitney_u(a, b)
+        result['log2fc'][begin:end] = log2_fold_change(a, b, pseudocount)
+
+    return result
+
+
+class SortedRows:
+    """=============================================================================================
+    Each row of the data is sorted once and the prefix sums of the sorted values and their squares
+    are saved. The sum and sum of squares of any contiguous range of sorted values is then a
+    difference of two prefix sums, so the trimmed mean and standard deviation for any trim
+    proportion cost O(1) per row; this makes it cheap to compare many trim fractions
+
+    usage
+        rows = SortedRows(og.counts)
+        for proportion in (0.2, 0.3, 0.5):
+            ave, std = rows.trimmed(proportion)
+    ============================================================================================="""
+
+    def __init__(self, data, ignore_zero=False, log1p=False):
+        """-----------------------------------------------------------------------------------------
+        attributes:
+            sorted      np.ndarray float64, data with each row sorted ascending
+            csum        np.ndarray float64, prefix sums of sorted, csum[:, j] is the sum of the
+                            first j values, one more column than data
+            csum2       np.ndarray float64, prefix sums of the squares of sorted
+            n           np.ndarray int64, number of values used in each row (non-zero values if
+                            ignore_zero)
+            ignore_zero bool, if True zeroes are not used (data must be non-negative)
+
+        :param data: np.ndarray     2D count matrix, rows are orthogroups
+        :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+        :param log1p: bool          if True, use log(1 + value)
+        -----------------------------------------------------------------------------------------"""
+        nrow, ncol = data.shape
+        self.sorted = np.sort(dense_rows(data, 0, nrow, log1p=log1p), axis=1)
+        self.csum = np.zeros((nrow, ncol + 1))
+        np.cumsum(self.sorted, axis=1, out=self.csum[:, 1:])
+        self.csum2 = np.zeros((nrow, ncol + 1))
+        np.cumsum(self.sorted * self.sorted, axis=1, out=self.csum2[:, 1:])
+
+        self.ignore_zero = ignore_zero
+        if ignore_zero:
+            self.n = np.count_nonzero(self.sorted, axis=1)
+        else:
+            self.n = np.full(nrow, ncol, dtype=np.int64)
+
+    def trimmed(self, proportion):
+        """-----------------------------------------------------------------------------------------
+        Trimmed mean and (population) standard deviation of each row, same result as
+        trimmed_mean_std(data, proportion, ignore_zero)
+
+        :param proportion: float    total fraction to trim, proportion/2 on each side
+        :return: np.ndarray, np.ndarray     trimmed mean and standard deviation of each row, NaN if
+                                            there are no values after trimming
+        -----------------------------------------------------------------------------------------"""
+        ncol = self.sorted.shape[1]
+        low, high = trim_bounds(self.n, proportion)
+
+        # the used values are the last n columns of the sorted row
+        begin = (ncol - self.n + low)[:, None]
+        end = (ncol - self.n + high)[:, None]
+        k = (end - begin)[:, 0].astype(np.float64)
+
+        total = np.take_along_axis(self.csum, end, axis=1) - np.take_along_axis(self.csum, begin, axis=1)
+        total = total[:, 0]
+        total2 = np.take_along_axis(self.csum2, end, axis=1) - np.take_along_axis(self.csum2, begin, axis=1)
+        total2 = total2[:, 0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ave = total / k
+            # k*sum(x^2) - sum(x)^2 is exact for integer counts; remove rounding error for others
+            var = (k * total2 - total * total) / (k * k)
+            var[var < 1e-12 * total2 / k] = 0
+
+        empty = k <= 0
+        ave[empty] = np.nan
+        var[empty] = np.nan
+
+        return ave, np.sqrt(var)
+
+    def median_mad(self):
+        """-----------------------------------------------------------------------------------------
+        Median and scaled MAD of each row from the saved sort, same result as
+        median_mad(data, ignore_zero)
+
+        :return: np.ndarray, np.ndarray     median and scale of each row
+        -----------------------------------------------------------------------------------------"""
+        return sorted_median_mad(self.sorted, self.n)
+
+
+# --------------------------------------------------------------------------------------------------
+# testing
+# --------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    from scipy.stats.mstats import trimmed_mean, trimmed_std
+
+    rng = np.random.default_rng(1)
+    for ncol in (5, 12, 13, 50):
+        test = rng.poisson(3, size=(1000, ncol))
+        for proportion in (0.0, 0.2, 0.25, 0.5, 0.8):
+            cut = proportion / 2
+            ave, std = trimmed_mean_std(test, proportion, chunk=100)
+            ref_ave = trimmed_mean(test, limits=(cut, cut), inclusive=(False, False), axis=1)
+            ref_std = trimmed_std(test, limits=(cut, cut), inclusive=(False, False), axis=1)
+            # identical, not just close, so that ties are ranked as with scipy
+            print(f'{ncol:4d} columns  proportion {proportion:.2f}  '
+                  f'mean {np.array_equal(ave, ref_ave)}  std {np.array_equal(std, ref_std)}')
+
+            # ignoring zeroes is the same as masking them
+            masked = np.ma.masked_equal(test, 0)
+            ave, std = trimmed_mean_std(test, proportion, ignore_zero=True, chunk=100)
+            ref_ave = trimmed_mean(masked, limits=(cut, cut), inclusive=(False, False), axis=1)
+            ref_std = trimmed_std(masked, limits=(cut, cut), inclusive=(False, False), axis=1)
+            print(f'{ncol:4d} columns  proportion {proportion:.2f}  ignore zero  '
+                  f'mean {np.allclose(ave, ref_ave.filled(np.nan), equal_nan=True)}  '
+                  f'std {np.allclose(std, ref_std.filled(np.nan), equal_nan=True)}')
+
+    # prefix sum statistics give the same result for any trim proportion
+    test = rng.poisson(3, size=(1000, 12))
+    for ignore_zero in (False, True):
+        rows = SortedRows(test, ignore_zero=ignore_zero)
+        for proportion in (0.0, 0.2, 0.25, 0.5, 0.8):
+            ave, std = rows.trimmed(proportion)
+            ref_ave, ref_std = trimmed_mean_std(test, proportion, ignore_zero=ignore_zero)
+            print(f'sorted rows  ignore zero {ignore_zero}  proportion {proportion:.2f}  '
+                  f'mean {np.allclose(ave, ref_ave, equal_nan=True)}  '
+                  f'std {np.allclose(std, ref_std, equal_nan=True)}')
+
+    # a trim fraction sweep of sparse counts, sorted in blocks, is the same as for dense counts
+    from types import SimpleNamespace
+    from scipy import sparse
+    from outliers import fraction_sweep
+
+    test = rng.poisson(0.5, size=(1000, 12)).astype(np.int32)
+    for ignore_zero in (False, True):
+        dense, dense_top = fraction_sweep(SimpleNamespace(counts=test), [0.2, 0.5], [1, 4], 10,
+                                          ignore_zero=ignore_zero)
+        sparse_z, sparse_top = fraction_sweep(SimpleNamespace(counts=sparse.csr_matrix(test)),
+                                              [0.2, 0.5], [1, 4], 10, ignore_zero=ignore_zero,
+                                              chunk=300)
+        print(f'sparse sweep  ignore zero {ignore_zero}  z {np.allclose(dense, sparse_z)}  '
+              f'groups {dense_top == sparse_top}')
+
+    # median and MAD agree with numpy, with and without log1p, and from the saved sort
+    test = rng.poisson(3, size=(1000, 12))
+    test[:5] = 0
+    for log1p in (False, True):
+        values = np.log1p(test) if log1p else test.astype(float)
+        ref_med = np.median(values, axis=1)
+        ref_mad = 1.4826 * np.median(np.abs(values - ref_med[:, None]), axis=1)
+        ref_mean_ad = 1.2533 * np.abs(values - ref_med[:, None]).mean(axis=1)
+        ref_scale = np.where(ref_mad > 0, ref_mad, ref_mean_ad)
+        med, scale = median_mad(test, chunk=300, log1p=log1p)
+        rows = SortedRows(test, log1p=log1p)
+        print(f'median/MAD  log1p {log1p}  median {np.allclose(med, ref_med)}  '
+              f'scale {np.allclose(scale, ref_scale)}  '
+              f'sorted rows {np.allclose(np.vstack(rows.median_mad()), np.vstack((med, scale)))}')
+
+    med, scale = median_mad(test, ignore_zero=True)
+    masked = np.ma.masked_equal(test, 0)
+    ref_med = np.ma.median(masked, axis=1).filled(np.nan)
+    print(f'median/MAD  ignore zero  median {np.allclose(med, ref_med, equal_nan=True)}')
+
+    # partial selection gives the same groups, in the same order, as a stable sort
+    for values in (rng.normal(size=10000), rng.integers(0, 20, size=10000).astype(float),
+                   np.zeros(50)):
+        ranked = sorted(range(len(values)), key=lambda g: values[g])
+        same = True
+        for n in (0, 1, 5, 20, 25, 100):
+            bottom, top = extremes(values, n)
+            same &= bottom.tolist() == ranked[:n] and top.tolist() == ranked[len(ranked) - n:]
+        print(f'extremes  {len(values)} values  same as sorted {same}')
+
+    # permutation p-values do not depend on the number of workers
+    z = rng.normal(size=(2000, 12))
+    observed = z[:, [1, 4]].mean(axis=1)
+    for n_perm in (20, 1000):
+        serial = permutation_test(z, observed, 2, n_perm, seed=7)
+        pooled = permutation_test(z, observed, 2, n_perm, seed=7, workers=3)
+        print(f'permutation  {n_perm} permutations  exact {serial[2]}  '
+              f'pool same {np.array_equal(serial[0], pooled[0]) and np.array_equal(serial[1], pooled[1])}  '
+              f'p range {serial[1].min():.4f} {serial[1].max():.4f}')
+
+    p = rng.random(500)
+    order = np.argsort(p)
+    ref = np.empty(len(p))
+    for rank in range(len(p)):
+        ref[order[rank]] = min(1, (p[order[rank:]] * len(p) / np.arange(rank + 1, len(p) + 1)).min())
+    print(f'bh q-values {np.allclose(bh_qvalues(p), ref)}')
+
+    # two sample tests agree with scipy.stats row by row
+    from scipy.stats import mannwhitneyu, ttest_ind
+
+    test = rng.poisson(3, size=(300, 12))
+    test[:10] = 0
+    test[10:20, :] = 4
+    test[10:20, 3] = 9
+    cols = [1, 3, 8]
+    result = target_tests(test, cols)
+    other = [c for c in range(12) if c not in cols]
+    ref_t = []
+    ref_u = []
+    for row in test:
+        res = ttest_ind(row[cols], row[other], equal_var=False)
+        ref_t.append((res.statistic, res.pvalue))
+        res = mannwhitneyu(row[cols], row[other], alternative='two-sided', method='asymptotic')
+        ref_u.append((res.statistic, res.pvalue))
+    ref_t = np.array(ref_t)
+    ref_u = np.array(ref_u)
+    varied = np.isfinite(ref_t[:, 0])
+    print(f'welch t {np.allclose(result["t"][varied], ref_t[varied, 0])}  '
+          f'p {np.allclose(result["t_p"][varied], ref_t[varied, 1])}  '
+          f'mann-whitney U {np.allclose(result["U"], ref_u[:, 0])}  '
+          f'p {np.allclose(result["U_p"], ref_u[:, 1], equal_nan=True)}')
+
+    exit(0)
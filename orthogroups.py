@@ -1,4 +1,29 @@
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+import queue
+import shutil
 import sys
+import threading
+from multiprocessing import Pool
+from array import array
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from scipy import sparse as scipy_sparse
+except ImportError:
+    scipy_sparse = None
 
 
 class Orthogroup:
@@ -12,35 +37,144 @@ class Orthogroup:
     Michael Gribskov     09 February 2024
     ============================================================================================="""
 
-    def __init__(self, filename='Orthogroups.tsv'):
+    cache_version = 3
+
+    def __init__(self, filename='Orthogroups.tsv', storage='list', cache=False, workers=1,
+                 species=None, sparse=False):
         """-----------------------------------------------------------------------------------------
+        storage selects how group membership is held in memory
+            list        group is a list of lists of lists of sequence names (str)
+            csr         group is a CompactGroups view, sequence names are stored once in
+                        self.sequence and decoded on demand (see CompactGroups)
+            lazy        group is a LazyGroups view, the file is memory mapped and only the byte
+                        offset and counts of each orthogroup are stored by groups_read(). a row
+                        is split into sequence names when it is accessed
+
+        if cache is True, the parsed data (proteome, counts, and csr membership) are saved in a
+        sidecar directory, <filename>.cache, and memory mapped from there on later runs as long as
+        the orthogroups file is unchanged (see cache_load()). Species subsets and sparse counts are
+        cached separately (see cache_path()). cache implies csr storage
+
+        compressed files (gzip, bzip2, xz, zstandard) are detected by open_safe() and decompressed
+        while they are read. A compressed file cannot be memory mapped or split into byte ranges, so
+        lazy storage is replaced by csr, and the file is read by a single process
+
+        if workers > 1, groups_read() splits the file into byte ranges that begin and end at line
+        boundaries and parses the ranges in a pool of worker processes (see groups_read_parallel())
+
+        counts can also be read from the OrthoFinder Orthogroups.GeneCount.tsv file with
+        genecount_read() instead of groups_read(). Member sequences are then read from filename
+        only for the orthogroups that are requested (members_fetch()). counts_read() does the same
+        with counts taken from filename itself
+
+        species is an optional list of organisms, matched to the part of the proteome name before
+        the first underline (e.g. Cap6580 for Cap6580_1_GeneCatalog_proteins_20221012.aa). Only the
+        sequences of these organisms are split and stored in group; the other species are empty
+        lists in group, but their counts are filled in by counting commas
+
+        if sparse is True, counts is a scipy.sparse CSR matrix. The matrix is built row by row as
+        the file is read (CountBuilder), so the dense matrix is never allocated; this requires
+        scipy. Use count_row() to get the counts of one orthogroup as an np.ndarray
+
         attributes:
+            filename    string, path to orthogroups file
             fh          filehandle with orthogroups data
             proteome    list, proteome files used in orthofineder run
             group       list, index is the orthogroup number, value is a list of species
                             each species is a list of sequences present in the group
                             group[og][species][sequence]
+            counts      np.ndarray int32, number of sequences in each orthogroup (row) and
+                            species (column), columns follow self.proteome. scipy.sparse
+                            csr_matrix if sparse
+            sparse      bool, counts is a sparse matrix
+            storage     string, 'list', 'csr', 'lazy', or 'fetch' (set by genecount_read() and
+                            counts_read())
+            cache       bool, use the binary cache in <filename>.cache
+            workers     int, number of processes used to read the orthogroups
+            compression string, compression format of filename, empty if not compressed
+            species     list, organisms whose sequences are stored, None for all
+            selected    list, bool for each proteome, True if its sequences are stored, None if
+                            all are stored
+            sequence    SequenceTable, all sequence names in file order (csr storage only)
+            row_ptr     np.ndarray int64, index in self.sequence of the first sequence of each
+                            orthogroup, length is number of groups + 1 (csr storage only)
+            mm          mmap of filename (lazy storage only)
+            line_ptr    np.ndarray int64, byte offset of each orthogroup line in mm, length is
+                            number of groups + 1 (lazy storage only)
+            fetched     dict, key is orthogroup number, value is the orthogroup row read by
+                            members_fetch() (fetch storage only)
 
         -----------------------------------------------------------------------------------------"""
+        self.filename = filename
         self.fh = None
         self.proteome = []
         self.group = []
+        self.counts = np.zeros((0, 0), dtype=np.int32)
+        self.storage = storage
+        self.cache = cache
+        if cache:
+            self.storage = 'csr'
+        self.workers = workers
+        self.sparse = sparse
+        if sparse and scipy_sparse is None:
+            sys.stderr.write('Orthogroup - scipy is needed for sparse counts\n')
+            exit(1)
+        self.compression = ''
+        self.species = species
+        self.selected = None
+        self.sequence = None
+        self.row_ptr = None
+        self.mm = None
+        self.line_ptr = None
+        self.fetched = {}
 
         if filename:
             self.fh = self.open_safe(filename)
+            self.compression = compression_type(filename)
+            if self.compression and (self.storage == 'lazy' or workers > 1):
+                if self.storage == 'lazy':
+                    self.storage = 'csr'
+                self.workers = 1
+                sys.stderr.write(f'Orthogroup - {self.compression} input ({filename}) is read by a '
+                                 f'single process with {self.storage} storage\n')
 
     def open_safe(self, filename, mode='r', status=1):
         """-----------------------------------------------------------------------------------------
         open file with error check, exit(status) if open fails.
         currently status==1 input file failure, status==2 output file failure
 
+        Files opened for reading are checked for compression (compression_type()). Compressed files
+        are decompressed in a background thread (ThreadedReader) so that decompression overlaps
+        with parsing; the returned filehandle reads the decompressed data
+
         :param filename: string     path to file
         :param mode: string         mode to open file
         :param status: int          exit status to use on failure
         :return: filehandle         open filehandle
         -----------------------------------------------------------------------------------------"""
         try:
-            fh = open(filename, mode)
+            compression = ''
+            if 'r' in mode and '+' not in mode:
+                compression = compression_type(filename)
+
+            if not compression:
+                fh = open(filename, mode)
+            elif compression == 'zstandard' and zstandard is None:
+                sys.stderr.write(f'Orthogroup.open_safe() - zstandard package is needed to read '
+                                 f'({filename})\n')
+                exit(status)
+            else:
+                opener = {'gzip': gzip.open, 'bzip2': bz2.open, 'xz': lzma.open}
+                if compression == 'zstandard':
+                    source = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'),
+                                                                        closefd=True)
+                else:
+                    source = opener[compression](filename, 'rb')
+
+                fh = io.BufferedReader(ThreadedReader(source), buffer_size=1 << 20)
+                if 'b' not in mode:
+                    fh = io.TextIOWrapper(fh)
+
         except IOError:
             sys.stderr.write(f'Orthogroup.open_safe() - cannot open file ({filename})\n')
             exit(status)
@@ -49,7 +183,8 @@ class Orthogroup:
 
     def proteome_read(self):
         """-----------------------------------------------------------------------------------------
-        Read the first line of data and save as list of proteome source files
+        Read the first line of data and save as list of proteome source files. If a subset of
+        species was given, mark the selected proteomes
 
         Format
         Orthogroup	Aurpu_var_nam1_GeneCatalog_proteins_20130418.aa	Cap6580_1_GeneCatalog_proteins_20221012.aa	...
@@ -62,12 +197,23 @@ class Orthogroup:
             seqfile = field[i]
             self.proteome.append(seqfile)
 
+        if self.species:
+            organism = [proteome.split('_')[0] for proteome in self.proteome]
+            for unknown in set(self.species) - set(organism):
+                sys.stderr.write(f'Orthogroup.proteome_read() - unknown organism ({unknown})\n')
+            self.selected = [org in self.species for org in organism]
+
         return len(self.proteome)
 
     def groups_read(self):
         """-----------------------------------------------------------------------------------------
         Read in the orthogroups. Store in self.group where the index is the orthogroup number, and
-        the value is a list sequences in it
+        the value is a list sequences in it. The number of sequences for each species is stored in
+        self.counts as the groups are read
+
+        With csr storage, the sequence names are appended to a single SequenceTable in file order
+        (orthogroup, then species, then sequence) and self.group is a CompactGroups view that
+        decodes rows on demand. With lazy storage, see groups_index()
 
         Format
         OG0000000		jgi|Cap6580_1|1008530|estExt_fgenesh1_pg.C_2540015, jgi|Cap6580_1|155246|CE155245_972 ...
@@ -77,25 +223,1181 @@ class Orthogroup:
 
         :return: int    number of sequences read
         -----------------------------------------------------------------------------------------"""
-        fh = self.fh
-        group = self.group
+        if self.storage == 'lazy':
+            return self.groups_index()
+
+        if self.cache and self.cache_load():
+            return int(self.counts.sum())
+
+        if self.workers > 1:
+            self.groups_read_parallel()
+        else:
+            fh = self.fh
+            group = self.group
+            n_proteome = len(self.proteome)
+            selected = self.selected
+            csr = self.storage == 'csr'
+            if csr:
+                sequence = SequenceTable()
+                row_ptr = array('q', [0])
+
+            # counts are accumulated row by row and converted to a matrix when all rows are read
+            count = CountBuilder(n_proteome, self.sparse)
+            for line in fh:
+                row = row_split(line, n_proteome, selected)
+                if selected:
+                    count.append(row_count(line, n_proteome))
+                else:
+                    count.append([len(seq) for seq in row])
+                if csr:
+                    for seq in row:
+                        sequence.extend(seq)
+                    row_ptr.append(len(sequence))
+                else:
+                    group.append(row)
+
+            self.counts = count.matrix()
+            if csr:
+                sequence.freeze()
+                self.sequence = sequence
+                self.row_ptr = np.frombuffer(row_ptr, dtype=np.int64)
+                self.group = CompactGroups(self)
+
+        if self.cache:
+            self.cache_save()
+
+        return int(self.counts.sum())
+
+    def groups_read_parallel(self):
+        """-----------------------------------------------------------------------------------------
+        Read the orthogroups with self.workers processes. The file, after the header line, is split
+        into byte ranges that end at line boundaries, each range is parsed by range_read(), and the
+        results are merged in file order. The result is the same as the serial read in
+        groups_read(). proteome_read() must be called first
+
+        :return: int    number of orthogroups read
+        -----------------------------------------------------------------------------------------"""
+        n_proteome = len(self.proteome)
+        ranges = range_split(self.filename, self.workers * 4)
+        with Pool(self.workers) as pool:
+            parts = pool.starmap(range_read, [(self.filename, begin, end, n_proteome, self.storage,
+                                               self.selected) for begin, end in ranges])
+
+        count = CountBuilder(n_proteome, self.sparse)
+        for part in parts:
+            count.extend(np.frombuffer(part['count'], dtype=np.int32).reshape(-1, n_proteome))
+        self.counts = count.matrix()
+        if self.storage == 'csr':
+            seq_len = np.concatenate([np.frombuffer(part['seq_len'], dtype=np.int64) for part in parts])
+            blob = np.frombuffer(b''.join(part['blob'] for part in parts), dtype=np.uint8)
+            self.sequence = SequenceTable(blob=blob, ptr=np.concatenate(([0], np.cumsum(seq_len))))
+            row_total = np.asarray(self.stored_counts().sum(axis=1)).ravel()
+            self.row_ptr = np.concatenate(([0], np.cumsum(row_total)))
+            self.group = CompactGroups(self)
+        else:
+            for part in parts:
+                self.group.extend(part['row'])
+
+        return self.counts.shape[0]
+
+    def stored_counts(self, g=None):
+        """-----------------------------------------------------------------------------------------
+        Counts of the sequences that are stored in group, i.e., counts with unselected species set
+        to zero when a species subset is used
+
+        :param g: int           orthogroup, if None all orthogroups
+        :return: np.ndarray     int64 counts for one orthogroup or all orthogroups (sparse matrix
+                                for all orthogroups if self.sparse)
+        -----------------------------------------------------------------------------------------"""
+        if self.sparse:
+            counts = self.counts if g is None else self.counts[g]
+            if self.selected:
+                counts = counts.multiply(np.array(self.selected)).tocsr()
+            if g is None:
+                return counts.astype(np.int64)
+            return counts.toarray()[0].astype(np.int64)
+
+        counts = self.counts if g is None else self.counts[g]
+        if self.selected:
+            return np.where(self.selected, counts, 0).astype(np.int64)
+
+        return counts.astype(np.int64)
+
+    def count_row(self, g):
+        """-----------------------------------------------------------------------------------------
+        Counts of one orthogroup for all species, for both dense and sparse counts
+
+        :param g: int           orthogroup
+        :return: np.ndarray     int32 counts, follows self.proteome
+        -----------------------------------------------------------------------------------------"""
+        if self.sparse:
+            return self.counts[g].toarray()[0]
+
+        return self.counts[g]
+
+    def species_tally(self):
+        """-----------------------------------------------------------------------------------------
+        Number of orthogroups that contain each species and number of sequences of each species in
+        all orthogroups. For sparse counts these are taken directly from the stored (non-zero)
+        values, the zeroes are never expanded
+
+        :return: np.ndarray, np.ndarray     int64 orthogroups per species, sequences per species
+        -----------------------------------------------------------------------------------------"""
+        n_proteome = len(self.proteome)
+        if self.sparse:
+            # explicit zeroes may be stored; counts is not modified, it may be a read-only mmap
+            counts = self.counts
+            nonzero = counts.data != 0
+            group_counts = np.bincount(counts.indices[nonzero], minlength=n_proteome)
+            seq_counts = np.bincount(counts.indices, weights=counts.data, minlength=n_proteome)
+            return group_counts.astype(np.int64), seq_counts.astype(np.int64)
+
+        group_counts = np.count_nonzero(self.counts, axis=0).astype(np.int64)
+        seq_counts = self.counts.sum(axis=0, dtype=np.int64)
+        return group_counts, seq_counts
+
+    def groups_index(self):
+        """-----------------------------------------------------------------------------------------
+        Lazy storage: memory map the orthogroups file and, in a single pass, record the byte offset
+        of each orthogroup line and count the sequences in each species by counting commas. The
+        sequence names are not split until a row is accessed through self.group (LazyGroups).
+        proteome_read() must be called first
+
+        :return: int    number of sequences in the orthogroups
+        -----------------------------------------------------------------------------------------"""
+        n_proteome = len(self.proteome)
+        with open(self.filename, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.workers > 1:
+            # the ranges are indexed in parallel, each returns absolute offsets
+            ranges = range_split(self.filename, self.workers * 4)
+            with Pool(self.workers) as pool:
+                parts = pool.starmap(range_read, [(self.filename, begin, end, n_proteome, 'lazy')
+                                                  for begin, end in ranges])
+            offset = np.concatenate([np.frombuffer(part['offset'], dtype=np.int64) for part in parts]
+                                    + [[len(mm)]])
+            count = CountBuilder(n_proteome, self.sparse)
+            for part in parts:
+                count.extend(np.frombuffer(part['count'], dtype=np.int32).reshape(-1, n_proteome))
+
+        else:
+            # skip the header line with the proteome names
+            pos = mm.find(b'\n') + 1
+            mm.seek(pos)
+
+            offset = array('q')
+            count = CountBuilder(n_proteome, self.sparse)
+            for line in iter(mm.readline, b''):
+                offset.append(pos)
+                pos += len(line)
+                count.append(row_count(line, n_proteome))
+
+            offset.append(pos)
+
+        self.mm = mm
+        self.line_ptr = np.frombuffer(offset, dtype=np.int64)
+        self.counts = count.matrix()
+        self.group = LazyGroups(self)
+
+        return int(self.counts.sum())
+
+    def genecount_read(self, filename):
+        """-----------------------------------------------------------------------------------------
+        Read self.counts from an OrthoFinder Orthogroups.GeneCount.tsv file in bulk with np.loadtxt.
+        The member sequences are not read; self.group becomes a FetchedGroups view and the members
+        of selected orthogroups are read from self.filename by members_fetch(), which should be
+        called with all the orthogroups that will be used
+
+        Format
+        Orthogroup	Aurpu_var_nam1_GeneCatalog_proteins_20130418.aa	...	Total
+        OG0000000	0	30	40	5	2	0	0	92	10	1	29	32	241
+
+        :param filename: string     path to Orthogroups.GeneCount.tsv
+        :return: int                number of sequences in the orthogroups
+        -----------------------------------------------------------------------------------------"""
+        fh = self.open_safe(filename)
+        proteome = fh.readline().rstrip().split('\t')[1:-1]
+        if self.proteome and proteome != self.proteome:
+            sys.stderr.write(f'Orthogroup.genecount_read() - proteomes in {filename} do not match '
+                             f'{self.filename}\n')
+            exit(1)
+        self.proteome = proteome
+
+        if self.sparse:
+            # read in blocks so that the dense matrix is never allocated
+            fh.close()
+            count = CountBuilder(len(proteome), self.sparse)
+            for block in self.counts_stream(1 << 16, genecount=filename):
+                count.extend(block)
+            self.counts = count.matrix()
+        else:
+            self.counts = np.loadtxt(fh, dtype=np.int32, delimiter='\t', ndmin=2,
+                                     usecols=range(1, len(proteome) + 1))
+            fh.close()
+
+        self.storage = 'fetch'
+        self.group = FetchedGroups(self)
+
+        return int(self.counts.sum())
+
+    def counts_read(self, chunk=1 << 16):
+        """-----------------------------------------------------------------------------------------
+        Read only self.counts from the orthogroups file, the sequences of each species are counted
+        (row_count()) but the member sequences are not split or stored. As with genecount_read(),
+        self.group becomes a FetchedGroups view and members are read by members_fetch() for the
+        orthogroups that are used. proteome_read() must be called first
+
+        :param chunk: int       number of rows read per block
+        :return: int            number of sequences in the orthogroups
+        -----------------------------------------------------------------------------------------"""
+        count = CountBuilder(len(self.proteome), self.sparse)
+        for block in self.counts_stream(chunk):
+            count.extend(block)
+        self.counts = count.matrix()
+
+        self.storage = 'fetch'
+        self.group = FetchedGroups(self)
+
+        return int(self.counts.sum())
+
+    def members_fetch(self, groups):
+        """-----------------------------------------------------------------------------------------
+        Read the member sequences of selected orthogroups from self.filename into self.fetched.
+        Only the requested lines are split, and reading stops after the last requested line
+
+        :param groups: list     orthogroup numbers
+        :return: int            number of orthogroups in self.fetched
+        -----------------------------------------------------------------------------------------"""
+        wanted = set(int(g) for g in groups) - set(self.fetched)
+        if not wanted:
+            return len(self.fetched)
+
+        n_proteome = len(self.proteome)
+        last = max(wanted)
+        fh = self.open_safe(self.filename)
+        fh.readline()
+        for g, line in enumerate(fh):
+            if g in wanted:
+                self.fetched[g] = row_split(line, n_proteome, self.selected)
+            if g == last:
+                break
+
+        fh.close()
+        return len(self.fetched)
+
+    def counts_stream(self, chunk, genecount=''):
+        """-----------------------------------------------------------------------------------------
+        Generator over the count matrix in blocks of at most chunk rows, for processing files that
+        are too large to hold in memory. The counts are read from the remaining lines of self.fh by
+        counting commas (row_count()), or from an Orthogroups.GeneCount.tsv file if genecount is
+        given. Nothing is stored in self.counts or self.group. proteome_read() must be called first
+
+        usage
+            og.proteome_read()
+            for block in og.counts_stream(100000):
+                total += block.sum(axis=0)
+
+        :param chunk: int           maximum number of rows in each block
+        :param genecount: string    path to Orthogroups.GeneCount.tsv, empty string to use self.fh
+        :return: np.ndarray         int32 counts, rows are orthogroups, columns are proteomes
+        -----------------------------------------------------------------------------------------"""
+        n_proteome = len(self.proteome)
+        if genecount:
+            fh = self.open_safe(genecount)
+            fh.readline()
+        else:
+            fh = self.fh
+
+        block = array('i')
+        nrow = 0
+        for line in fh:
+            if genecount:
+                block.extend(int(count) for count in line.split('\t')[1:n_proteome + 1])
+            else:
+                block.extend(row_count(line, n_proteome))
+            nrow += 1
+
+            if nrow == chunk:
+                yield np.frombuffer(block, dtype=np.int32).reshape(-1, n_proteome)
+                block = array('i')
+                nrow = 0
+
+        if nrow:
+            yield np.frombuffer(block, dtype=np.int32).reshape(-1, n_proteome)
+
+        if genecount:
+            fh.close()
+
+    def groups_count(self, filename=''):
+        """-----------------------------------------------------------------------------------------
+        Number of orthogroup lines (after the header line) in an orthogroups or gene count file,
+        found by counting newlines without parsing
+
+        :param filename: string     path to file, self.filename if empty
+        :return: int                number of orthogroups
+        -----------------------------------------------------------------------------------------"""
+        fh = self.open_safe(filename or self.filename, 'rb')
+        n = 0
+        last = b'\n'
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            n += block.count(b'\n')
+            last = block[-1:]
+        fh.close()
+
+        if last != b'\n':
+            # last line has no newline
+            n += 1
+
+        return n - 1
+
+    def iter_groups(self):
+        """-----------------------------------------------------------------------------------------
+        Generator over the orthogroups that reads one line at a time from self.fh and yields a
+        GroupRecord. Nothing is stored in self.group or self.counts, so memory use does not depend
+        on the size of the file. proteome_read() must be called first
+
+        usage
+            og = Orthogroup('Orthogroups.tsv')
+            og.proteome_read()
+            for record in og.iter_groups():
+                if record.counts[0] > 10:
+                    print(record.name, record.members[0])
+
+        :return: GroupRecord    next orthogroup
+        -----------------------------------------------------------------------------------------"""
+        n_proteome = len(self.proteome)
+        for line in self.fh:
+            yield GroupRecord(line, n_proteome)
+
+    def sequence_index(self):
+        """-----------------------------------------------------------------------------------------
+        Build a reverse index from sequence name to orthogroup and species for the groups that have
+        been read (any storage). Orthogroups are named OG<number>, as in the OrthoFinder output
+
+        :return: SequenceIndex      sorted, hashed index of all sequences
+        -----------------------------------------------------------------------------------------"""
+        index = SequenceIndex()
+        for g, row in enumerate(self.group):
+            index.add(row, f'OG{g:07d}')
+        index.finish()
+
+        return index
+
+    def cache_path(self):
+        """-----------------------------------------------------------------------------------------
+        Each variant of the parsed data (species subset, dense or sparse counts) has its own
+        directory in the sidecar cache directory, <filename>.cache/<variant>, so runs with
+        different options never replace the arrays that another run has memory mapped
+
+        :return: string     path to the cache directory for self.filename and this variant
+        -----------------------------------------------------------------------------------------"""
+        variant = 'sparse' if self.sparse else 'dense'
+        if self.selected:
+            species = bytes(bool(s) for s in self.selected)
+            variant += '.' + hashlib.blake2b(species, digest_size=8).hexdigest()
+
+        return os.path.join(f'{self.filename}.cache', variant)
+
+    def cache_load(self):
+        """-----------------------------------------------------------------------------------------
+        Load counts and csr membership from the cache directory if it is valid for the current
+        orthogroups file. The arrays are memory mapped, not read. The cache is valid if the file
+        size and modification time are unchanged; if only the modification time has changed (e.g.
+        the file was copied or touched) the content hash is recomputed and compared. A cache that
+        cannot be read is ignored, and the orthogroups are parsed
+
+        :return: bool       True if the cache was loaded
+        -----------------------------------------------------------------------------------------"""
+        cachedir = self.cache_path()
+        try:
+            with open(os.path.join(cachedir, 'meta.json'), 'r') as metafh:
+                meta = json.load(metafh)
+        except (OSError, ValueError):
+            return False
+
+        stat = os.stat(self.filename)
+        if meta.get('version') != Orthogroup.cache_version or meta['size'] != stat.st_size:
+            return False
+        if self.proteome and meta['proteome'] != self.proteome:
+            return False
+        if meta.get('selected') != self.selected or meta.get('sparse', False) != self.sparse:
+            return False
+
+        if meta['mtime_ns'] != stat.st_mtime_ns:
+            if meta['hash'] != Orthogroup.file_hash(self.filename):
+                return False
+
+            # same content, update the modification time so the hash is not needed next time
+            meta['mtime_ns'] = stat.st_mtime_ns
+            self.cache_meta_write(meta)
+
+        def npy(name):
+            return np.load(os.path.join(cachedir, f'{name}.npy'), mmap_mode='r')
+
+        try:
+            if self.sparse:
+                indptr = npy('counts_indptr')
+                counts = scipy_sparse.csr_matrix((npy('counts_data'), npy('counts_indices'), indptr),
+                                                 shape=(len(indptr) - 1, len(meta['proteome'])))
+            else:
+                counts = npy('counts')
+            row_ptr = npy('row_ptr')
+            sequence = SequenceTable(blob=npy('sequence_blob'), ptr=npy('sequence_ptr'))
+        except (OSError, ValueError):
+            return False
+
+        self.proteome = meta['proteome']
+        self.counts = counts
+        self.row_ptr = row_ptr
+        self.sequence = sequence
+        self.group = CompactGroups(self)
+
+        return True
+
+    def cache_save(self):
+        """-----------------------------------------------------------------------------------------
+        Write the proteome list, counts, and csr membership arrays to the cache directory as .npy
+        files that can be memory mapped. The cache is written in a temporary directory that is
+        renamed when it is complete, so an incomplete cache is never used and the files of a cache
+        that another process has memory mapped are not overwritten. Failure to write the cache is
+        reported but is not fatal
+
+        :return: bool       True if the cache was written
+        -----------------------------------------------------------------------------------------"""
+        cachedir = self.cache_path()
+        tmpdir = f'{cachedir}.tmp{os.getpid()}'
+        stat = os.stat(self.filename)
+        meta = {'version': Orthogroup.cache_version,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'hash': Orthogroup.file_hash(self.filename),
+                'proteome': self.proteome,
+                'selected': self.selected,
+                'sparse': self.sparse}
+        try:
+            os.makedirs(tmpdir, exist_ok=True)
+            if self.sparse:
+                np.save(os.path.join(tmpdir, 'counts_data.npy'), self.counts.data)
+                np.save(os.path.join(tmpdir, 'counts_indices.npy'), self.counts.indices)
+                np.save(os.path.join(tmpdir, 'counts_indptr.npy'), self.counts.indptr)
+            else:
+                np.save(os.path.join(tmpdir, 'counts.npy'), self.counts)
+            np.save(os.path.join(tmpdir, 'row_ptr.npy'), self.row_ptr)
+            np.save(os.path.join(tmpdir, 'sequence_blob.npy'), self.sequence.blob)
+            np.save(os.path.join(tmpdir, 'sequence_ptr.npy'), self.sequence.ptr)
+            self.cache_meta_write(meta, tmpdir)
+
+            if os.path.isdir(cachedir):
+                # open memory maps of the old files stay valid after they are removed
+                olddir = f'{cachedir}.old{os.getpid()}'
+                os.rename(cachedir, olddir)
+                shutil.rmtree(olddir, ignore_errors=True)
+            os.rename(tmpdir, cachedir)
+        except OSError:
+            sys.stderr.write(f'Orthogroup.cache_save() - cannot write cache ({cachedir})\n')
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return False
+
+        return True
+
+    def cache_meta_write(self, meta, cachedir=None):
+        """-----------------------------------------------------------------------------------------
+        The metadata are written to a temporary file that replaces meta.json, so a reader never
+        sees a partial file
+
+        :param meta: dict       cache metadata, written to <cachedir>/meta.json
+        :param cachedir: string cache directory, default cache_path()
+        :return: None
+        -----------------------------------------------------------------------------------------"""
+        cachedir = cachedir or self.cache_path()
+        tmpfile = os.path.join(cachedir, f'meta.json.tmp{os.getpid()}')
+        with open(tmpfile, 'w') as metafh:
+            json.dump(meta, metafh)
+        os.replace(tmpfile, os.path.join(cachedir, 'meta.json'))
+
+        return None
+
+    @staticmethod
+    def file_hash(filename, blocksize=1 << 24):
+        """-----------------------------------------------------------------------------------------
+        content hash of a file, read in blocks
+
+        :param filename: string     path to file
+        :param blocksize: int       bytes per read
+        :return: string             blake2b hex digest
+        -----------------------------------------------------------------------------------------"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as fh:
+            for block in iter(lambda: fh.read(blocksize), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+
+def compression_type(filename):
+    """---------------------------------------------------------------------------------------------
+    identify compressed files by their leading magic bytes
+
+    :param filename: string     path to file
+    :return: string             gzip, bzip2, xz, zstandard, or empty string if not compressed
+    ---------------------------------------------------------------------------------------------"""
+    magic = {b'\x1f\x8b': 'gzip',
+             b'BZh': 'bzip2',
+             b'\xfd7zXZ\x00': 'xz',
+             b'\x28\xb5\x2f\xfd': 'zstandard'}
+
+    with open(filename, 'rb') as fh:
+        head = fh.read(6)
+
+    for prefix in magic:
+        if head.startswith(prefix):
+            return magic[prefix]
+
+    return ''
+
+
+class ThreadedReader(io.RawIOBase):
+    """=============================================================================================
+    Raw binary stream that reads blocks from a source stream in a background thread. Used for
+    decompression so that the decompressor (which releases the GIL) runs while the main thread
+    parses the previous block. Wrap in io.BufferedReader (and io.TextIOWrapper for text)
+    ============================================================================================="""
+
+    def __init__(self, source, blocksize=1 << 20, depth=8):
+        """-----------------------------------------------------------------------------------------
+        :param source: filehandle   binary stream, e.g. gzip.open(filename, 'rb')
+        :param blocksize: int       bytes per read from source
+        :param depth: int           maximum number of blocks waiting to be read
+        -----------------------------------------------------------------------------------------"""
+        super().__init__()
+        self.source = source
+        self.blocksize = blocksize
+        self.block = queue.Queue(depth)
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def produce(self):
+        """-----------------------------------------------------------------------------------------
+        background thread: read blocks from source until end of file or close(). An exception in
+        the source is passed through the queue and raised in the reading thread
+        -----------------------------------------------------------------------------------------"""
+        try:
+            while not self.stop.is_set():
+                block = self.source.read(self.blocksize)
+                self.block.put(block)
+                if not block:
+                    break
+        except Exception as err:
+            self.block.put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """-----------------------------------------------------------------------------------------
+        :param buffer: writable buffer      destination
+        :return: int                        number of bytes copied, 0 at end of file
+        -----------------------------------------------------------------------------------------"""
+        while not self.pending and not self.eof:
+            block = self.block.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.eof = True
+            self.pending = memoryview(block)
+
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+
+        return n
+
+    def close(self):
+        """-----------------------------------------------------------------------------------------
+        stop the background thread and close the source
+        -----------------------------------------------------------------------------------------"""
+        if not self.closed:
+            self.stop.set()
+            while self.thread.is_alive():
+                # unblock the producer if the queue is full
+                try:
+                    self.block.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.source.close()
+
+        super().close()
+
+
+def row_split(line, n_proteome, selected=None):
+    """---------------------------------------------------------------------------------------------
+    Split one line of the orthogroups file into a list of sequences for each species. Species
+    that are absent from the orthogroup, including those after the last field, are empty lists.
+    If selected is given, only the selected species are split, the others are empty lists
+
+    :param line: string         orthogroup line, tab delimited species, comma delimited sequences
+    :param n_proteome: int      number of proteomes (species)
+    :param selected: list       bool for each species, True if the species should be split
+    :return: list               one list of sequence names (str) for each species
+    ---------------------------------------------------------------------------------------------"""
+    field = line.rstrip().split('\t')
+    row = [[] for _ in range(n_proteome)]
+    s = 0
+    for species in field[1:]:
+        if selected and not selected[s]:
+            s += 1
+            continue
+
+        seq = species.replace(', ', ',').split(',')
+        if seq[0] != '':
+            # species is present in this orthogroup
+            row[s] = seq
+
+        s += 1
+
+    return row
+
+
+def row_count(line, n_proteome):
+    """---------------------------------------------------------------------------------------------
+    Count the sequences for each species in one line of the orthogroups file without splitting the
+    sequence names (the number of commas in each species field + 1)
+
+    :param line: bytes or str   orthogroup line, tab delimited species, comma delimited sequences
+    :param n_proteome: int      number of proteomes (species)
+    :return: list               number of sequences (int) for each species
+    ---------------------------------------------------------------------------------------------"""
+    tab, comma = (b'\t', b',') if isinstance(line, bytes) else ('\t', ',')
+    count = [species.count(comma) + 1 if species else 0 for species in line.rstrip().split(tab)[1:]]
+    count.extend([0] * (n_proteome - len(count)))
+
+    return count
+
+
+def range_split(filename, n_range):
+    """---------------------------------------------------------------------------------------------
+    Divide the orthogroup lines of a file (everything after the header line) into approximately
+    equal byte ranges. Each range begins at the start of a line and ends after a newline (or at the
+    end of the file)
+
+    :param filename: string     path to orthogroups file
+    :param n_range: int         number of ranges, fewer are returned for small files
+    :return: list               (begin, end) byte offsets for each range
+    ---------------------------------------------------------------------------------------------"""
+    with open(filename, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    size = len(mm)
+    begin = mm.find(b'\n') + 1
+    step = max((size - begin) // n_range, 1)
+    ranges = []
+    while begin < size:
+        end = mm.find(b'\n', min(begin + step, size) - 1) + 1
+        if end == 0:
+            end = size
+        ranges.append((begin, end))
+        begin = end
+
+    mm.close()
+    return ranges
+
+
+def range_read(filename, begin, end, n_proteome, storage, selected=None):
+    """---------------------------------------------------------------------------------------------
+    Parse the orthogroup lines in one byte range of a file; this is the worker function for
+    Orthogroup.groups_read_parallel() and Orthogroup.groups_index(). Arrays are returned as bytes
+    so they can be passed back from a worker process efficiently
+
+    :param filename: string     path to orthogroups file
+    :param begin: int           offset of first line in range
+    :param end: int             offset after the last line in range
+    :param n_proteome: int      number of proteomes (species)
+    :param storage: string      list, csr, or lazy (see Orthogroup)
+    :param selected: list       bool for each species, True if the species should be split
+    :return: dict               count: int32 counts, row by row
+                                row: list of rows from row_split() (list)
+                                blob, seq_len: sequence names and int64 lengths in bytes (csr)
+                                offset: int64 absolute offset of each line (lazy)
+    ---------------------------------------------------------------------------------------------"""
+    with open(filename, 'rb') as fh:
+        fh.seek(begin)
+        data = fh.read(end - begin)
+
+    lines = data.split(b'\n')
+    if not lines[-1]:
+        # range ends with a newline
+        lines.pop()
+
+    count = array('i')
+    part = {}
+    if storage == 'lazy':
+        offset = array('q')
+        pos = begin
+        for line in lines:
+            offset.append(pos)
+            pos += len(line) + 1
+            count.extend(row_count(line, n_proteome))
+        part['offset'] = offset.tobytes()
+
+    else:
+        rows = []
+        blob = bytearray()
+        seq_len = array('q')
+        for line in lines:
+            row = row_split(line.decode(), n_proteome, selected)
+            if selected:
+                count.extend(row_count(line, n_proteome))
+            else:
+                count.extend([len(seq) for seq in row])
+            if storage == 'csr':
+                for seq in row:
+                    for name in seq:
+                        encoded = name.encode()
+                        blob += encoded
+                        seq_len.append(len(encoded))
+            else:
+                rows.append(row)
+
+        part['row'] = rows
+        part['blob'] = bytes(blob)
+        part['seq_len'] = seq_len.tobytes()
+
+    part['count'] = count.tobytes()
+    return part
+
+
+class GroupRecord:
+    """=============================================================================================
+    One orthogroup from Orthogroup.iter_groups(). The counts are computed when the record is
+    created, the line is split into sequence names only if members is used
+    ============================================================================================="""
+    __slots__ = ('name', 'counts', 'line', 'n_proteome', '_members')
+
+    def __init__(self, line, n_proteome):
+        """-----------------------------------------------------------------------------------------
+        attributes:
+            name        string, orthogroup ID, e.g., OG0000000
+            counts      np.ndarray int32, number of sequences in each species
+            line        string, the orthogroup line from the file
+
+        :param line: string         orthogroup line, tab delimited species, comma delimited sequences
+        :param n_proteome: int      number of proteomes (species)
+        -----------------------------------------------------------------------------------------"""
+        self.name = line[:line.find('\t')]
+        self.counts = np.array(row_count(line, n_proteome), dtype=np.int32)
+        self.line = line
+        self.n_proteome = n_proteome
+        self._members = None
 
-        n_seq = 0
+    @property
+    def members(self):
+        """-----------------------------------------------------------------------------------------
+        :return: list       one list of sequence names for each species, empty if absent
+        -----------------------------------------------------------------------------------------"""
+        if self._members is None:
+            self._members = row_split(self.line, self.n_proteome)
+
+        return self._members
+
+
+class SequenceIndex:
+    """=============================================================================================
+    Reverse index from sequence name to (orthogroup, species). Names are not stored; each name is
+    reduced to a 64-bit hash (seq_hash()) and the hashes are kept in a sorted array with parallel
+    orthogroup and species arrays, so a lookup is a binary search. The index can be saved with
+    save() and reloaded with SequenceIndex.load() instead of being rebuilt
+
+    build
+        index = SequenceIndex()
+        for row in rows:
+            index.add(row, name)
+        index.finish()
+    ============================================================================================="""
+
+    def __init__(self):
+        """-----------------------------------------------------------------------------------------
+        attributes:
+            key         np.ndarray uint64, sorted hashes of sequence names
+            og          np.ndarray int32, orthogroup number of each key
+            species     np.ndarray int32, species (proteome) index of each key
+            name        list, name of each orthogroup (str)
+        -----------------------------------------------------------------------------------------"""
+        self.key = array('Q')
+        self.og = array('i')
+        self.species = array('i')
+        self.name = []
+
+    def __len__(self):
+        return len(self.key)
+
+    def add(self, row, name=''):
+        """-----------------------------------------------------------------------------------------
+        Add the sequences of one orthogroup; orthogroups are numbered in the order they are added
+
+        :param row: list        one list of sequence names for each species
+        :param name: string     orthogroup name
+        :return: int            number of orthogroups in index
+        -----------------------------------------------------------------------------------------"""
+        g = len(self.name)
+        for s, seq in enumerate(row):
+            for sequence in seq:
+                self.key.append(seq_hash(sequence))
+                self.og.append(g)
+                self.species.append(s)
+
+        self.name.append(name)
+        return len(self.name)
+
+    def finish(self):
+        """-----------------------------------------------------------------------------------------
+        Sort the index by key, must be called after the last add()
+
+        :return: int            number of sequences in index
+        -----------------------------------------------------------------------------------------"""
+        key = np.frombuffer(self.key, dtype=np.uint64)
+        order = np.argsort(key, kind='stable')
+        self.key = key[order]
+        self.og = np.frombuffer(self.og, dtype=np.int32)[order]
+        self.species = np.frombuffer(self.species, dtype=np.int32)[order]
+
+        return len(self.key)
+
+    def lookup(self, sequence):
+        """-----------------------------------------------------------------------------------------
+        :param sequence: string     sequence name
+        :return: tuple              (orthogroup number, species index), None if not present
+        -----------------------------------------------------------------------------------------"""
+        key = np.uint64(seq_hash(sequence))
+        i = int(np.searchsorted(self.key, key))
+        if i < len(self.key) and self.key[i] == key:
+            return int(self.og[i]), int(self.species[i])
+
+        return None
+
+    def lookup_many(self, sequences):
+        """-----------------------------------------------------------------------------------------
+        Vectorized lookup of a list of sequence names
+
+        :param sequences: list      sequence names (str)
+        :return: np.ndarray, np.ndarray     orthogroup number and species index of each sequence,
+                                            -1 if not present
+        -----------------------------------------------------------------------------------------"""
+        key = np.fromiter((seq_hash(sequence) for sequence in sequences), dtype=np.uint64,
+                          count=len(sequences))
+        og = np.full(len(key), -1, dtype=np.int32)
+        species = np.full(len(key), -1, dtype=np.int32)
+        if len(self.key):
+            i = np.searchsorted(self.key, key)
+            i[i == len(self.key)] = 0
+            found = self.key[i] == key
+            og[found] = self.og[i[found]]
+            species[found] = self.species[i[found]]
+
+        return og, species
+
+    def save(self, filename):
+        """-----------------------------------------------------------------------------------------
+        Save the index as an uncompressed .npz file
+
+        :param filename: string     path to index file
+        :return: int                number of sequences in index
+        -----------------------------------------------------------------------------------------"""
+        with open(filename, 'wb') as fh:
+            np.savez(fh, key=self.key, og=self.og, species=self.species, name=np.array(self.name))
+
+        return len(self.key)
+
+    @staticmethod
+    def load(filename):
+        """-----------------------------------------------------------------------------------------
+        :param filename: string     path to index file written by save()
+        :return: SequenceIndex      index ready for lookups
+        -----------------------------------------------------------------------------------------"""
+        index = SequenceIndex()
+        with np.load(filename) as data:
+            index.key = data['key']
+            index.og = data['og']
+            index.species = data['species']
+            index.name = data['name'].tolist()
+
+        return index
+
+
+def seq_hash(sequence):
+    """---------------------------------------------------------------------------------------------
+    64-bit hash of a sequence name. Unlike hash(), the value is the same in every process so it can
+    be saved
+
+    :param sequence: string     sequence name
+    :return: int                hash value
+    ---------------------------------------------------------------------------------------------"""
+    return int.from_bytes(hashlib.blake2b(sequence.encode(), digest_size=8).digest(), 'little')
+
+
+class CountBuilder:
+    """=============================================================================================
+    Accumulates the count matrix row by row while an orthogroups file is read. Dense counts are
+    kept in a flat int32 buffer; sparse counts keep only the non-zero values of each row in CSR
+    form (indptr, indices, data), so a matrix with thousands of mostly empty species columns is
+    never allocated densely
+
+    usage
+        count = CountBuilder(n_proteome, sparse=True)
         for line in fh:
-            field = line.rstrip().split('\t')
-            row = [[] for _ in range(len(self.proteome))]
-            group.append(row)
-            s = 0
-            for species in field[1:]:
-                seq = species.replace(', ', ',').split(',')
-                if seq[0] != '':
-                    # species is present in this orthogroup
-                    row[s] = seq
+            count.append(row_count(line, n_proteome))
+        counts = count.matrix()
+    ============================================================================================="""
+
+    def __init__(self, n_proteome, sparse=False):
+        """-----------------------------------------------------------------------------------------
+        :param n_proteome: int      number of proteomes (columns)
+        :param sparse: bool         build a scipy.sparse csr_matrix instead of an np.ndarray
+        -----------------------------------------------------------------------------------------"""
+        self.n_proteome = n_proteome
+        self.sparse = sparse
+        self.data = array('i')
+        self.indices = array('i')
+        self.indptr = array('q', [0])
 
-                s += 1
-                n_seq += len(seq)
+    def append(self, row):
+        """-----------------------------------------------------------------------------------------
+        :param row: list    counts (int) of one orthogroup for each proteome
+        :return: None
+        -----------------------------------------------------------------------------------------"""
+        if self.sparse:
+            for column, n in enumerate(row):
+                if n:
+                    self.indices.append(column)
+                    self.data.append(n)
+            self.indptr.append(len(self.data))
+        else:
+            self.data.extend(row)
+
+        return None
+
+    def extend(self, block):
+        """-----------------------------------------------------------------------------------------
+        :param block: np.ndarray    2D int32 counts, rows are orthogroups
+        :return: None
+        -----------------------------------------------------------------------------------------"""
+        if self.sparse:
+            row, column = np.nonzero(block)
+            self.indices.extend(column.astype(np.int32))
+            self.data.extend(block[row, column].astype(np.int32))
+            row_end = np.cumsum(np.bincount(row, minlength=len(block))) + self.indptr[-1]
+            self.indptr.extend(row_end.astype(np.int64))
+        else:
+            self.data.frombytes(np.ascontiguousarray(block, dtype=np.int32).tobytes())
+
+        return None
+
+    def matrix(self):
+        """-----------------------------------------------------------------------------------------
+        :return: np.ndarray or scipy.sparse.csr_matrix     int32 counts
+        -----------------------------------------------------------------------------------------"""
+        data = np.frombuffer(self.data, dtype=np.int32)
+        if self.sparse:
+            indptr = np.frombuffer(self.indptr, dtype=np.int64)
+            return scipy_sparse.csr_matrix((data, np.frombuffer(self.indices, dtype=np.int32), indptr),
+                                           shape=(len(indptr) - 1, self.n_proteome))
+
+        return data.reshape(-1, self.n_proteome)
+
+
+class SequenceTable:
+    """=============================================================================================
+    Compact table of sequence names. All names are stored once, utf-8 encoded, in a single byte
+    buffer; ptr[i] is the offset of name i in the buffer and ptr[i+1] is its end. While the table
+    is being built, the buffers are python bytearray/array objects, freeze() converts them to numpy
+    arrays
+    ============================================================================================="""
+
+    def __init__(self, blob=None, ptr=None):
+        """-----------------------------------------------------------------------------------------
+        attributes:
+            blob        bytearray or np.ndarray uint8, concatenated sequence names
+            ptr         array or np.ndarray int64, offset of each name in blob, length is number of
+                            names + 1
+
+        :param blob: np.ndarray     existing name buffer, e.g., loaded from disk
+        :param ptr: np.ndarray      existing offsets for blob
+        -----------------------------------------------------------------------------------------"""
+        if blob is None:
+            self.blob = bytearray()
+            self.ptr = array('q', [0])
+        else:
+            self.blob = blob
+            self.ptr = ptr
+
+    def __len__(self):
+        return len(self.ptr) - 1
 
-        return n_seq
+    def __getitem__(self, i):
+        """-----------------------------------------------------------------------------------------
+        :param i: int       index of sequence name
+        :return: string     sequence name
+        -----------------------------------------------------------------------------------------"""
+        return bytes(self.blob[self.ptr[i]:self.ptr[i + 1]]).decode()
+
+    def extend(self, names):
+        """-----------------------------------------------------------------------------------------
+        Add a list of sequence names to the end of the table
+
+        :param names: list      sequence names (str)
+        :return: int            number of names in table
+        -----------------------------------------------------------------------------------------"""
+        blob = self.blob
+        ptr = self.ptr
+        for name in names:
+            blob += name.encode()
+            ptr.append(len(blob))
+
+        return len(ptr) - 1
+
+    def slice(self, begin, end):
+        """-----------------------------------------------------------------------------------------
+        Decode a range of sequence names
+
+        :param begin: int       index of first name
+        :param end: int         index after the last name
+        :return: list           sequence names (str)
+        -----------------------------------------------------------------------------------------"""
+        ptr = self.ptr[begin:end + 1].tolist()
+        base = ptr[0]
+        text = bytes(self.blob[base:ptr[-1]])
+
+        return [text[ptr[i] - base:ptr[i + 1] - base].decode() for i in range(end - begin)]
+
+    def freeze(self):
+        """-----------------------------------------------------------------------------------------
+        Convert the growing python buffers to numpy arrays, no more names can be added. The arrays
+        are views of the buffers, so the names are not copied
+
+        :return: int            number of names in table
+        -----------------------------------------------------------------------------------------"""
+        self.blob = np.frombuffer(self.blob, dtype=np.uint8)
+        self.ptr = np.frombuffer(self.ptr, dtype=np.int64)
+
+        return len(self.ptr) - 1
+
+
+class GroupView:
+    """=============================================================================================
+    Read-only view of orthogroup membership that supports the same queries as the list storage:
+    len(group), iteration, and group[og][species][sequence]. Rows are built by row() when they are
+    accessed, so changes to a returned row are not saved. Subclasses implement row()
+    ============================================================================================="""
+
+    def __init__(self, og):
+        """-----------------------------------------------------------------------------------------
+        :param og: Orthogroup       orthogroup object that holds the data
+        -----------------------------------------------------------------------------------------"""
+        self.og = og
+
+    def __len__(self):
+        return self.og.counts.shape[0]
+
+    def __getitem__(self, g):
+        """-----------------------------------------------------------------------------------------
+        :param g: int       orthogroup index
+        :return: list       one list of sequence names for each species, empty if absent
+        -----------------------------------------------------------------------------------------"""
+        n = len(self)
+        if g < 0:
+            g += n
+        if not 0 <= g < n:
+            raise IndexError(f'{type(self).__name__} - orthogroup index out of range ({g})')
+
+        return self.row(g)
+
+    def __iter__(self):
+        for g in range(len(self)):
+            yield self.row(g)
+
+    def row(self, g):
+        raise NotImplementedError
+
+
+class CompactGroups(GroupView):
+    """=============================================================================================
+    View of compact (csr) orthogroup membership. The sequences of orthogroup og are
+    sequence[row_ptr[og]:row_ptr[og+1]], in species order; the number in each species is given by
+    counts[og]
+    ============================================================================================="""
+
+    def row(self, g):
+        """-----------------------------------------------------------------------------------------
+        decode one orthogroup
+
+        :param g: int       orthogroup index
+        :return: list       one list of sequence names for each species, empty if absent
+        -----------------------------------------------------------------------------------------"""
+        og = self.og
+        names = og.sequence.slice(int(og.row_ptr[g]), int(og.row_ptr[g + 1]))
+        row = []
+        pos = 0
+        for n_seq in og.stored_counts(g).tolist():
+            row.append(names[pos:pos + n_seq])
+            pos += n_seq
+
+        return row
+
+
+class FetchedGroups(GroupView):
+    """=============================================================================================
+    View of orthogroup membership when the counts come from Orthogroups.GeneCount.tsv. Rows are
+    taken from Orthogroup.fetched; a row that has not been fetched is read with members_fetch(),
+    which rereads the file, so fetch all the needed rows at once. Iteration reads the file once and
+    splits each row as it is read, the rows are not saved in Orthogroup.fetched
+    ============================================================================================="""
+
+    def __iter__(self):
+        og = self.og
+        n_proteome = len(og.proteome)
+        fh = og.open_safe(og.filename)
+        fh.readline()
+        for g, line in enumerate(fh):
+            if g in og.fetched:
+                yield og.fetched[g]
+            else:
+                yield row_split(line, n_proteome, og.selected)
+
+        fh.close()
+
+    def row(self, g):
+        """-----------------------------------------------------------------------------------------
+        :param g: int       orthogroup index
+        :return: list       one list of sequence names for each species, empty if absent
+        -----------------------------------------------------------------------------------------"""
+        og = self.og
+        if g not in og.fetched:
+            og.members_fetch([g])
+
+        return og.fetched[g]
+
+
+class LazyGroups(GroupView):
+    """=============================================================================================
+    View of lazily read orthogroup membership. Orthogroup og is the line at
+    mm[line_ptr[og]:line_ptr[og+1]], it is split with row_split() each time it is accessed. Only
+    selected species are split if a species subset is used
+    ============================================================================================="""
+
+    def row(self, g):
+        """-----------------------------------------------------------------------------------------
+        split one orthogroup line
+
+        :param g: int       orthogroup index
+        :return: list       one list of sequence names for each species, empty if absent
+        -----------------------------------------------------------------------------------------"""
+        og = self.og
+        line = og.mm[og.line_ptr[g]:og.line_ptr[g + 1]].decode()
+
+        return row_split(line, len(og.proteome), og.selected)
 
 
 # --------------------------------------------------------------------------------------------------
@@ -114,25 +1416,30 @@ if __name__ == '__main__':
         for s in og.group[g]:
             print(f'\t{s}')
 
-    # count the number of orthogroups that each species is in
-    counts = [ 0 for _ in range(n_proteome)]
-    for g in og.group:
-        for s in range(n_proteome):
-            if len(g[s]) > 0:
-                counts[s] += 1
+    # count the number of orthogroups that each species is in, and the number of sequences per
+    # species, streaming through the file without storing the groups
+    og = Orthogroup('data/Orthogroups.tsv')
+    og.proteome_read()
+    group_counts = np.zeros(n_proteome, dtype=np.int64)
+    seq_counts = np.zeros(n_proteome, dtype=np.int64)
+    for record in og.iter_groups():
+        group_counts += record.counts > 0
+        seq_counts += record.counts
+
+    # the same tallies from sparse counts, only the non-zero counts are stored
+    og = Orthogroup('data/Orthogroups.tsv', storage='lazy', sparse=True)
+    og.proteome_read()
+    og.groups_read()
+    sparse_groups, sparse_seqs = og.species_tally()
+    print(f'\nsparse counts: {og.counts.nnz} of {og.counts.shape[0] * n_proteome} stored, tallies '
+          f'agree {np.array_equal(group_counts, sparse_groups) and np.array_equal(seq_counts, sparse_seqs)}')
 
     print('\northogroups per species')
     for s in range(n_proteome):
-        print(f'{counts[s]}\t{og.proteome[s]}')
-
-    # count the number of sequences per species
-    counts = [0 for _ in range(n_proteome)]
-    for g in og.group:
-        for s in range(n_proteome):
-            counts[s] += len(g[s])
+        print(f'{group_counts[s]}\t{og.proteome[s]}')
 
     print('\nsequences per species')
     for s in range(n_proteome):
-        print(f'{counts[s]}\t{og.proteome[s]}')
+        print(f'{seq_counts[s]}\t{og.proteome[s]}')
 
     exit(0)
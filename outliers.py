@@ -17,14 +17,18 @@ group[i][j][k] are the individual matching sequences
 ================================================================================================="""
 import argparse
 import datetime
+import gzip
 import json
+import os
 import sys
 
 import numpy as np
-from scipy.stats.mstats import trimmed_mean, trimmed_std
 
 from json_custom_encoder import CompactJSONEncoder
-from orthogroups import Orthogroup
+from og_cache import ResultCache
+from og_stats import (SortedRows, bh_qvalues, extremes, median_mad, normalize, permutation_test,
+                      target_tests, trimmed_mean_std)
+from orthogroups import FetchedGroups, Orthogroup
 
 
 def process_command_line():
@@ -48,7 +52,7 @@ def process_command_line():
 
     cl.add_argument('-f', '--fraction',
                     help='total fraction of observations to trim in mean/std.dev. calculation',
-                    type=int,
+                    type=float,
                     default=0.5)
 
     cl.add_argument('-t', '--target',
@@ -66,53 +70,391 @@ def process_command_line():
                     type=str,
                     default='')
 
+    cl.add_argument('-s', '--storage',
+                    help='orthogroup membership storage: list, csr (compact), or lazy (memory mapped)',
+                    type=str,
+                    choices=['list', 'csr', 'lazy'],
+                    default='list')
+
+    cl.add_argument('-c', '--cache',
+                    help='save/reuse parsed orthogroups in a binary cache next to ORTHOGROUP (implies csr)',
+                    action='store_true',
+                    default=False)
+
+    cl.add_argument('-w', '--workers',
+                    help='number of processes used to read ORTHOGROUP',
+                    type=int,
+                    default=1)
+
+    cl.add_argument('-m', '--members',
+                    help='load member sequences for all organisms, only for target organisms, or none '
+                         '(report only counts, outliers_fasta.py reads the members from ORTHOGROUP)',
+                    type=str,
+                    choices=['all', 'target', 'none'],
+                    default='all')
+
+    cl.add_argument('-G', '--genecount',
+                    help='Orthogroups.GeneCount.tsv file, counts are read from this file and member '
+                         'sequences from ORTHOGROUP only for the reported groups',
+                    type=str,
+                    default='')
+
+    cl.add_argument('-z', '--ignore_zero',
+                    help='omit zero counts from the trimmed mean/std.dev. calculation',
+                    action='store_true',
+                    default=False)
+
+    cl.add_argument('-S', '--sweep',
+                    help='comma delimited list of trim fractions; report z-scores and top/bottom '
+                         'groups for each fraction (JSON and TSV hold the sweep results)',
+                    type=str,
+                    default='')
+
+    cl.add_argument('-b', '--batch',
+                    help='file of named target sets, one per line: name and comma delimited list of '
+                         'target organisms; replaces --target',
+                    type=str,
+                    default='')
+
+    cl.add_argument('-p', '--permutations',
+                    help='number of random target sets for permutation p-values (0 = no test)',
+                    type=int,
+                    default=0)
+
+    cl.add_argument('-r', '--seed',
+                    help='random seed for the permutation test',
+                    type=int,
+                    default=None)
+
+    cl.add_argument('-T', '--tests',
+                    help='two sample tests of target vs. other organism counts: Welch t, Mann-Whitney U, '
+                         'and log2 fold change',
+                    action='store_true',
+                    default=False)
+
+    cl.add_argument('-P', '--pseudocount',
+                    help='pseudocount added to the mean counts for log2 fold change',
+                    type=float,
+                    default=1.0)
+
+    cl.add_argument('-k', '--chunk',
+                    help='stream the counts in blocks of CHUNK orthogroups so that memory does not '
+                         'depend on the number of orthogroups (0 = read all)',
+                    type=int,
+                    default=0)
+
+    cl.add_argument('-x', '--sparse',
+                    help='hold the counts in a sparse matrix (requires scipy), for runs with many '
+                         'proteomes and mostly empty orthogroups',
+                    action='store_true',
+                    default=False)
+
+    cl.add_argument('-M', '--method',
+                    help='row normalization: trimmed mean/std.dev., or median/MAD (robust)',
+                    type=str,
+                    choices=['trimmed', 'mad'],
+                    default='trimmed')
+
+    cl.add_argument('-l', '--log1p',
+                    help='normalize log(1 + count) instead of count',
+                    action='store_true',
+                    default=False)
+
+    cl.add_argument('-e', '--precision',
+                    help='significant digits of values in the TSV file (default full precision); '
+                         'TSV files ending in .gz are compressed, .npy files are binary',
+                    type=int,
+                    default=None)
+
+    cl.add_argument('-C', '--result_cache',
+                    help='directory for cached counts and normalized z; runs with the same ORTHOGROUP '
+                         'content and normalization reuse them without reading or normalizing',
+                    type=str,
+                    default='')
+
+    cl.add_argument('-L', '--cache_limit',
+                    help='size limit of RESULT_CACHE in MB, least recently used results are removed',
+                    type=float,
+                    default=1024)
+
     return cl.parse_args()
 
 
-def trimmed_stats(og, proportion, ignore_zero=True):
+def target_sets_read(filename):
+    """---------------------------------------------------------------------------------------------
+    Read named target sets for a batch run. Each line has a set name and a comma delimited list of
+    target organisms separated by white space. Blank lines and lines beginning with # are skipped
+        cold    Cap6580,Delst1
+        dry     Horwer1,Myrdu1,Zasce1
+
+    :param filename: string     file with target sets
+    :return: dict               {name: [organism, ...]} in the order of the file
+    ---------------------------------------------------------------------------------------------"""
+    try:
+        fh = open(filename, 'r')
+    except OSError:
+        sys.stderr.write(f'outliers - unable to open target set file ({filename})\n')
+        exit(1)
+
+    target_sets = {}
+    for line in fh:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        field = line.split(maxsplit=1)
+        if len(field) < 2 or field[0] in target_sets:
+            sys.stderr.write(f'outliers - bad or duplicate target set ({line})\n')
+            exit(1)
+
+        target_sets[field[0]] = [t.strip() for t in field[1].split(',') if t.strip()]
+
+    fh.close()
+    return target_sets
+
+
+def target_matrix(target_sets, organism, n_proteome):
+    """---------------------------------------------------------------------------------------------
+    Indicator matrix for the target sets, rows are target sets and columns are proteomes. A row is
+    1 for each proteome in the set and 0 otherwise
+
+    :param target_sets: dict    {name: [organism, ...]}
+    :param organism: dict       column index of each organism
+    :param n_proteome: int      number of proteomes (columns of og.counts)
+    :return: np.ndarray         indicator matrix (float64)
+    ---------------------------------------------------------------------------------------------"""
+    indicator = np.zeros((len(target_sets), n_proteome))
+    for row, name in enumerate(target_sets):
+        for t in target_sets[name]:
+            try:
+                indicator[row, organism[t]] = 1
+            except KeyError:
+                sys.stderr.write(f'Unknown organism ({t})')
+                exit(2)
+
+    return indicator
+
+
+def target_means(z, target_cols):
+    """---------------------------------------------------------------------------------------------
+    Mean target z of each target set, z[:, cols].mean(axis=1) with the columns in the order the
+    organisms are listed. Every code path (dense, sparse, chunked, and og_server.py) uses this
+    calculation on the same z, so the values are identical and orthogroups with equal z are ranked
+    the same way
+
+    :param z: np.ndarray        normalized counts, rows are orthogroups
+    :param target_cols: list    column indices of the organisms in each target set
+    :return: np.ndarray         mean target z, rows are orthogroups and columns are target sets
+    ---------------------------------------------------------------------------------------------"""
+    set_z = np.empty((z.shape[0], len(target_cols)))
+    for s, cols in enumerate(target_cols):
+        set_z[:, s] = z[:, cols].mean(axis=1)
+
+    return set_z
+
+
+def group_report(og, orgidx, selected, groups, blank=False, stats=None, counts_only=False,
+                 out=None):
+    """---------------------------------------------------------------------------------------------
+    Print the counts and member sequences of the selected groups and return them for the JSON
+    output. Each statistic in stats, e.g., permutation p and q, is added to the groups by name
+
+    With counts_only, the member sequences are not reported; each group has 'Counts', the number of
+    sequences of each organism, instead of 'Members', and og.group is not used
+
+    :param og: Orthogroup       Othogroup object with counts and groups
+    :param orgidx: list         organism name of each proteome
+    :param selected: np.ndarray mean target z of each orthogroup
+    :param groups: list         orthogroup numbers to report
+    :param blank: bool          if True, add '' to the members of proteomes with a zero count
+    :param stats: dict          {name: np.ndarray}, value of each statistic for each orthogroup,
+                                values that are not finite are null in the JSON
+    :param counts_only: bool    if True, report counts without the member sequences
+    :param out: filehandle      where the report is printed, default sys.stdout
+    :return: list of dict       [{'og_num':int, 'z':float, 'Members':[[organism, count, seq, ...]]}]
+                                or [{'og_num':int, 'z':float, 'Counts':[count, ...]}]
+    ---------------------------------------------------------------------------------------------"""
+    report = []
+    for g in groups:
+        this_group = {'og_num': g, 'z': selected[g], 'Counts' if counts_only else 'Members': []}
+        print(f'\nOrthogroup {g:6d}\t{selected[g]:.3f}', end='', file=out)
+        for name in stats or {}:
+            value = float(stats[name][g])
+            # NaN and inf are not valid JSON, e.g., Welch t when a group has a single organism
+            this_group[name] = value if np.isfinite(value) else None
+            print(f'\t{name}={value:.3g}', end='', file=out)
+        print(file=out)
+        report.append(this_group)
+        if counts_only:
+            this_group['Counts'] = count = og.count_row(g).tolist()
+            print('\t' + '\t'.join(f'{orgidx[i]}: {count[i]}' for i in range(len(orgidx))),
+                  file=out)
+            continue
+
+        members = this_group['Members']
+        row = og.group[g]
+        count = og.count_row(g)
+        for i in range(len(orgidx)):
+            print(f'\t{orgidx[i]}: {count[i]}\t{row[i]}', file=out)
+            members.append([orgidx[i], int(count[i])] + row[i])
+            if blank and count[i] == 0:
+                # organisms without member sequences loaded (--members target) stay empty
+                members[-1].append('')
+
+    return report
+
+
+def json_name(filename, name, batch):
+    """---------------------------------------------------------------------------------------------
+    JSON output file for a target set. In a batch run the set name is added before the extension,
+    e.g., outliers.json -> outliers.cold.json
+
+    :param filename: string     JSON file from the command line
+    :param name: string         target set name
+    :param batch: bool          True for a batch run
+    :return: string             JSON file name
+    ---------------------------------------------------------------------------------------------"""
+    if not batch:
+        return filename
+
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{name}{ext or ".json"}'
+
+
+def trimmed_stats(og, proportion, ignore_zero=False, dtype=np.float64, chunk=1 << 16,
+                  method='trimmed', log1p=False):
     """---------------------------------------------------------------------------------------------
     return the trimmed mean and standard deviation. proportion defines how much data is omitted on
     each side (proportion/2). After sorting the first index used is the first >= proportion/2 and
     the last is the one <= 1.0 - proportion/2
 
-    :param og: list             Othogroup object, rows are orthogroups
+    The statistics are calculated by og_stats.trimmed_mean_std(), which matches
+    scipy.stats.mstats.trimmed_mean/trimmed_std with inclusive=(False, False). Rows are processed
+    in blocks of chunk rows so the only full size array is the result
+
+    With ignore_zero, each row is trimmed over its own non-zero values and the zeroes are not used
+    for the mean and standard deviation; all values, including zeroes, are normalized. Rows with no
+    usable values are normalized with mean 0 and standard deviation 1
+
+    method 'mad' replaces the trimmed mean and standard deviation by the median and scaled median
+    absolute deviation (og_stats.median_mad()); proportion is not used. With log1p, log(1 + count)
+    is normalized
+
+    :param og: Orthogroup       Othogroup object, og.counts rows are orthogroups
     :param proportion:          proportion to trim proportion/2 trimmed on each side
-    :param ignore_zero: bool    NOT IMPLEMENTED. if True, zeroes are omitted otherwise they are
-                                treated as values
-    :return: float, float       Z normalized data
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param dtype: np.dtype      float type of the result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param method: string       'trimmed' or 'mad'
+    :param log1p: bool          if True, normalize log(1 + count)
+    :return: np.ndarray         Z normalized data
     ---------------------------------------------------------------------------------------------"""
-    # use_zero = not ignore_zero
-    cut = proportion / 2
-
-    # nil = 0
-    # if ignore_zero:
-    #     nil = np.nan
-    data = og.group
-    norm = np.full([len(data), len(og.proteome)], np.nan)
-
-    # make count vector from original data, and store in norm using zero or NaN depending
-    # on the state of ignore_zero
-    ngroup = len(data)
-    for g in range(ngroup):
-        nspecie = len(data[g])
-        norm[g] = [len(data[g][s]) for s in range(nspecie)]
-
-    # if ignore_zero:
-    #     norm[norm == 0] = np.nan
-
-    # mean and standard deviation, values are trimmed until index+1 >= n*cut
-    # for n=12 and cut = .125, two values are cut off
-
-    ave = trimmed_mean(norm, limits=(cut, cut), inclusive=(False, False), axis=1)
-    std = trimmed_std(norm, limits=(cut, cut), inclusive=(False, False), axis=1)
+    # count matrix is built by Orthogroup.groups_read(), rows are groups, columns are proteomes
+    return trimmed_z(og.counts, proportion, ignore_zero=ignore_zero, dtype=dtype, chunk=chunk,
+                     method=method, log1p=log1p)
+
+
+def trimmed_z(counts, proportion, ignore_zero=False, dtype=np.float64, chunk=1 << 16,
+              method='trimmed', log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Trimmed standard normal deviates of a count matrix, see trimmed_stats(). Rows are independent,
+    so a block of rows gives the same result as the full matrix
+
+    :param counts: np.ndarray   2D count matrix, rows are orthogroups
+    :param proportion:          proportion to trim proportion/2 trimmed on each side
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param dtype: np.dtype      float type of the result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param method: string       'trimmed' or 'mad'
+    :param log1p: bool          if True, normalize log(1 + count)
+    :return: np.ndarray         Z normalized data
+    ---------------------------------------------------------------------------------------------"""
+    ave, std = trimmed_ave_std(counts, proportion, ignore_zero=ignore_zero, dtype=dtype, chunk=chunk,
+                               method=method, log1p=log1p)
+
+    return normalize(counts, ave, std, dtype=dtype, chunk=chunk, log1p=log1p)
+
+
+def trimmed_ave_std(counts, proportion, ignore_zero=False, dtype=np.float64, chunk=1 << 16,
+                    method='trimmed', log1p=False):
+    """---------------------------------------------------------------------------------------------
+    Trimmed mean and standard deviation (or median and MAD) used to normalize each row, see
+    trimmed_stats(). Rows with no usable values have mean 0 and standard deviation 1, and a
+    standard deviation of 0 is replaced by 1
+
+    :param counts: np.ndarray   2D count matrix (or scipy.sparse matrix), rows are orthogroups
+    :param proportion:          proportion to trim proportion/2 trimmed on each side
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param dtype: np.dtype      float type of the result, float64 or float32
+    :param chunk: int           number of rows per block
+    :param method: string       'trimmed' or 'mad'
+    :param log1p: bool          if True, use log(1 + count)
+    :return: np.ndarray, np.ndarray     mean and standard deviation of each row
+    ---------------------------------------------------------------------------------------------"""
+    if method == 'mad':
+        ave, std = median_mad(counts, ignore_zero=ignore_zero, dtype=dtype, chunk=chunk, log1p=log1p)
+    else:
+        # mean and standard deviation, values are trimmed until index+1 >= n*cut
+        # for n=12 and cut = .125, two values are cut off
+        ave, std = trimmed_mean_std(counts, proportion, ignore_zero=ignore_zero, dtype=dtype,
+                                    chunk=chunk, log1p=log1p)
+    if ignore_zero:
+        # rows with no non-zero values
+        empty = np.isnan(ave)
+        ave[empty] = 0
+        std[empty] = 1
     std[std == 0] = 1
 
-    return ((norm.T - ave) / std).T
+    return ave, std
+
+
+def fraction_sweep(og, fractions, cols, ntop, ignore_zero=False, log1p=False, chunk=1 << 16):
+    """---------------------------------------------------------------------------------------------
+    Normalize and rank the orthogroups for several trim fractions. The rows are sorted once
+    (og_stats.SortedRows) and the trimmed mean and standard deviation for each fraction are read
+    from the prefix sums. Rows are sorted in blocks of chunk rows, so only one block is expanded
+    when the counts are sparse
+
+    :param og: Orthogroup       Othogroup object, og.counts rows are orthogroups
+    :param fractions: list      trim fractions (float)
+    :param cols: list           column indices of the target organisms
+    :param ntop: int            number of top/bottom groups to report
+    :param ignore_zero: bool    if True, zeroes are omitted otherwise they are treated as values
+    :param log1p: bool          if True, normalize log(1 + count)
+    :param chunk: int           number of rows per block
+    :return: np.ndarray, dict   mean target z for each orthogroup (row) and fraction (column),
+                                top/bottom groups for each fraction
+                                {fraction: {'Reduced':[[og_num, z], ...], 'Expanded':[...]}}
+    ---------------------------------------------------------------------------------------------"""
+    nrow = og.counts.shape[0]
+    selected = np.empty((nrow, len(fractions)))
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        block = og.counts[begin:end]
+        rows = SortedRows(block, ignore_zero=ignore_zero, log1p=log1p)
+        for f in range(len(fractions)):
+            ave, std = rows.trimmed(fractions[f])
+            empty = np.isnan(ave)
+            ave[empty] = 0
+            std[empty | (std == 0)] = 1
+
+            z = normalize(block[:, cols], ave, std, log1p=log1p)
+            selected[begin:end, f] = z.mean(axis=1)
+
+    result = {}
+    for f in range(len(fractions)):
+        bottom, top = extremes(selected[:, f], ntop)
+        result[fractions[f]] = {
+            'Reduced': [[g, selected[g, f]] for g in bottom.tolist()],
+            'Expanded': [[g, selected[g, f]] for g in top.tolist()]}
+
+    return selected, result
 
 
 def tsv_write(opt, col_labels, z):
     """---------------------------------------------------------------------------------------------
-    if opt.tsv, write a tab delimited file with the normalized data
+    if opt.tsv, write a tab delimited file with the normalized data (see TableWriter for gzip and
+    .npy output)
 
     :param opt: namespace       command line options
     :param col_labels: list     column labels (str)
@@ -123,27 +465,207 @@ def tsv_write(opt, col_labels, z):
     if not opt.tsv:
         return 0
 
-    tsvfp = open(opt.tsv, 'w')
+    writer = TableWriter(opt.tsv, col_labels, nrow=len(z), precision=opt.precision)
+    writer.write(z)
+
+    return writer.close()
+
+
+class TableWriter:
+    """=============================================================================================
+    Writes the normalized data, one row per orthogroup, in blocks of rows. The output format is set
+    by the file name:
+        *.npy       binary NumPy array (float64), preallocated and memory mapped so blocks can be
+                    written as they are calculated; the number of rows must be given. The row
+                    (orthogroup) and column labels are written to a sidecar JSON file,
+                    <filename>.labels.json, {'columns': [label, ...], 'rows': [OG0000000, ...]}
+        *.gz        gzip compressed TSV
+        otherwise   TSV
+
+    TSV rows are formatted a block at a time with a single format string per row (%-formatting of
+    the whole row), and each block is written with one call to a large buffer. Values are written
+    in full precision (repr) unless precision gives the number of significant digits
+
+    usage
+        writer = TableWriter('z.tsv.gz', labels, precision=6)
+        for begin, block in blocks:
+            writer.write(block)
+        writer.close()
+    ============================================================================================="""
+
+    def __init__(self, filename, col_labels, nrow=None, precision=None, block=1 << 14):
+        """-----------------------------------------------------------------------------------------
+        :param filename: string     output file, format is set by the extension
+        :param col_labels: list     column labels (str), one for each column of data
+        :param nrow: int            number of rows, required for .npy output
+        :param precision: int       significant digits, None for full precision
+        :param block: int           number of rows formatted at a time
+        -----------------------------------------------------------------------------------------"""
+        self.filename = filename
+        self.col_labels = list(col_labels)
+        self.block = block
+        self.nline = 0
+        self.npy = None
+        self.fh = None
+
+        ncol = len(self.col_labels)
+        if filename.endswith('.npy'):
+            self.npy = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                                 shape=(nrow, ncol))
+            return
+
+        if filename.endswith('.gz'):
+            self.fh = gzip.open(filename, 'wt', compresslevel=6)
+        else:
+            self.fh = open(filename, 'w', buffering=1 << 20)
+
+        value = '%r' if precision is None else f'%.{precision}g'
+        self.row_format = 'OG%07d' + f'\t{value}' * ncol
+        self.fh.write('\t'.join(['Orthogroup'] + self.col_labels) + '\n')
+
+    def write(self, z):
+        """-----------------------------------------------------------------------------------------
+        append rows; the rows are named by their orthogroup number, i.e., the number of rows
+        written before them
+
+        :param z: np.ndarray        2D, one column for each label
+        :return: int                number of rows written
+        -----------------------------------------------------------------------------------------"""
+        if z.shape[1] != len(self.col_labels):
+            sys.stderr.write(f'outliers - {z.shape[1]} data columns do not match '
+                             f'{len(self.col_labels)} column labels ({self.filename})\n')
+            exit(2)
+
+        first = self.nline
+        if self.npy is not None:
+            self.npy[first:first + len(z)] = z
+            self.nline += len(z)
+            return len(z)
+
+        row_format = self.row_format
+        for begin in range(0, len(z), self.block):
+            rows = np.asarray(z[begin:begin + self.block], dtype=np.float64).tolist()
+            number = range(first + begin, first + begin + len(rows))
+            text = '\n'.join([row_format % (g, *row) for g, row in zip(number, rows)])
+            self.fh.write(text + '\n')
+
+        self.nline += len(z)
+        return len(z)
+
+    def close(self):
+        """-----------------------------------------------------------------------------------------
+        flush and close the output, for .npy also write the label sidecar
+
+        :return: int                number of rows written
+        -----------------------------------------------------------------------------------------"""
+        if self.npy is not None:
+            self.npy.flush()
+            self.npy = None
+            with open(f'{self.filename}.labels.json', 'w') as labelfh:
+                json.dump({'columns': self.col_labels,
+                           'rows': [f'OG{g:07d}' for g in range(self.nline)]}, labelfh)
+        else:
+            self.fh.close()
+
+        return self.nline
+
+
+def tsv_normalized(opt, col_labels, counts, ave, std, columns, chunk=1 << 16, log1p=False):
+    """---------------------------------------------------------------------------------------------
+    if opt.tsv, write the normalized counts, followed by any additional columns, without
+    allocating the full z matrix. Blocks of chunk rows are normalized and written in turn; used
+    for sparse counts
+
+    :param opt: namespace       command line options
+    :param col_labels: list     column labels (str), proteomes and additional columns
+    :param counts: np.ndarray   2D count matrix (or scipy.sparse matrix), rows are orthogroups
+    :param ave: np.ndarray      mean of each row
+    :param std: np.ndarray      standard deviation of each row
+    :param columns: list        additional columns, np.ndarray with one value per row
+    :param chunk: int           number of rows per block
+    :param log1p: bool          if True, normalize log(1 + count)
+    :return: int                number of lines written
+    ---------------------------------------------------------------------------------------------"""
+    if not opt.tsv:
+        return 0
+
+    nrow = counts.shape[0]
+    writer = TableWriter(opt.tsv, col_labels, nrow=nrow, precision=opt.precision)
+    for begin in range(0, nrow, chunk):
+        end = min(begin + chunk, nrow)
+        z = normalize(counts[begin:end], ave[begin:end], std[begin:end], log1p=log1p)
+        writer.write(np.hstack([z] + [column[begin:end, None] for column in columns]))
+
+    return writer.close()
+
 
-    # column lables
-    tsvfp.write(f'Orthogroup')
-    for label in col_labels:
-        tsvfp.write(f'\t{label}')
-    tsvfp.write('\n')
+def stream_rank(opt, og, target_cols, col_labels):
+    """---------------------------------------------------------------------------------------------
+    Out of core normalization and ranking. The counts are read in blocks of opt.chunk orthogroups
+    (Orthogroup.counts_stream()), each block is normalized and its z values are written to opt.tsv
+    as they are calculated (TableWriter). For each target set, only the groups that can still be
+    among the opt.ntop lowest or highest are kept, so memory depends on the block size, not the
+    number of orthogroups.
 
-    # data matrix
-    # TODO may not be writing the last column
-    nline = 0
-    for row in z:
-        tsvfp.write(f'OG{nline:07d}')
-        for col in range(len(row)):
-            tsvfp.write(f'\t{row[col]}')
+    Ties are broken by orthogroup number, as in extremes(), so the result is the same as ranking
+    the full matrix
 
-        tsvfp.write('\n')
-        nline += 1
+    :param opt: namespace       command line options
+    :param og: Orthogroup       Orthogroup object after proteome_read()
+    :param target_cols: list    column indices of the organisms in each target set
+    :param col_labels: list     column labels (str) for the TSV file
+    :return: list, list, dict   (bottom, top) orthogroup lists for each set, {og_num: z} for each
+                                set, {og_num: counts} for the reported groups
+    ---------------------------------------------------------------------------------------------"""
+    nset = len(target_cols)
 
-    tsvfp.close()
-    return nline
+    writer = None
+    if opt.tsv:
+        nrow = None
+        if opt.tsv.endswith('.npy'):
+            # the file is preallocated so the number of orthogroups is needed first
+            nrow = og.groups_count(opt.genecount)
+        writer = TableWriter(opt.tsv, col_labels, nrow=nrow, precision=opt.precision)
+
+    # candidates for each set in order of orthogroup number
+    cand_idx = [np.empty(0, dtype=np.int64) for _ in range(nset)]
+    cand_val = [np.empty(0) for _ in range(nset)]
+    cand_counts = {}
+
+    begin = 0
+    for block in og.counts_stream(opt.chunk, opt.genecount):
+        end = begin + len(block)
+        z = trimmed_z(block, opt.fraction, ignore_zero=opt.ignore_zero, method=opt.method,
+                      log1p=opt.log1p)
+        if writer:
+            writer.write(z)
+
+        set_z = target_means(z, target_cols)
+        index = np.arange(begin, end)
+        for s in range(nset):
+            values = np.concatenate((cand_val[s], set_z[:, s]))
+            idx = np.concatenate((cand_idx[s], index))
+            bottom, top = extremes(values, opt.ntop)
+            keep = np.union1d(bottom, top)
+            cand_idx[s] = idx[keep]
+            cand_val[s] = values[keep]
+
+        # counts of the candidates, new candidates come from this block
+        kept = set(np.concatenate(cand_idx).tolist())
+        cand_counts = {g: cand_counts[g] if g < begin else block[g - begin].copy() for g in kept}
+        begin = end
+
+    if writer:
+        writer.close()
+
+    ranking = []
+    selected = []
+    for s in range(nset):
+        bottom, top = extremes(cand_val[s], opt.ntop)
+        ranking.append((cand_idx[s][bottom].tolist(), cand_idx[s][top].tolist()))
+        selected.append(dict(zip(cand_idx[s].tolist(), cand_val[s].tolist())))
+
+    return ranking, selected, cand_counts
 
 
 # ==================================================================================================
@@ -156,23 +678,89 @@ if __name__ == '__main__':
 
     sys.stderr.write(f'\noutliers.py {runstart}\n')
     sys.stderr.write(f'Trim fraction: {opt.fraction}\n')
+    sys.stderr.write(f'Ignore zero counts: {opt.ignore_zero}\n')
+    sys.stderr.write(f'Normalization: {opt.method}{" log1p" if opt.log1p else ""}\n')
+    if opt.sweep and opt.method != 'trimmed':
+        sys.stderr.write('outliers - --sweep varies the trim fraction and needs --method trimmed\n')
+        exit(1)
     sys.stderr.write(f'Top groups: {opt.ntop}\n')
     sys.stderr.write(f'Orthogroups: {opt.orthogroup}\n')
-    jsonfile = None
+    sys.stderr.write(f'Membership storage: {opt.storage}\n')
+    if opt.permutations:
+        sys.stderr.write(f'Permutations: {opt.permutations}\tseed: {opt.seed}\n')
+    if opt.genecount:
+        sys.stderr.write(f'Gene counts: {opt.genecount}\n')
+    if opt.cache:
+        sys.stderr.write(f'Orthogroup cache: {opt.orthogroup}.cache\n')
     if opt.json:
         sys.stderr.write(f'JSON Output: {opt.json}\n')
-        jsonfile = open(opt.json, 'w')
     if opt.tsv:
         sys.stderr.write(f'TSV output: {opt.tsv}\n')
-
-    target = opt.target.split(',')
-    sys.stderr.write(f'\nTargets: {opt.target}\n\n')
-
-    og = Orthogroup(opt.orthogroup)
+    if opt.sparse:
+        sys.stderr.write('Sparse counts: True\n')
+    if opt.chunk:
+        sys.stderr.write(f'Streaming in blocks of {opt.chunk} orthogroups\n')
+        if opt.sweep or opt.permutations or opt.tests:
+            sys.stderr.write('outliers - --sweep, --permutations, and --tests need all the counts in '
+                             'memory and are not available with --chunk\n')
+            exit(1)
+    if opt.result_cache:
+        sys.stderr.write(f'Result cache: {opt.result_cache}\tlimit: {opt.cache_limit:g} MB\n')
+        if opt.chunk or opt.sparse or opt.sweep:
+            sys.stderr.write('outliers - --result_cache stores the full z matrix and is not available '
+                             'with --chunk, --sparse, or --sweep\n')
+            exit(1)
+
+    if opt.batch:
+        if opt.sweep:
+            sys.stderr.write('outliers - --sweep is not available for batch target sets\n')
+            exit(1)
+        target_sets = target_sets_read(opt.batch)
+        sys.stderr.write(f'\nTarget sets: {opt.batch} ({len(target_sets)} sets)\n')
+    else:
+        target_sets = {opt.target: opt.target.split(',')}
+        sys.stderr.write(f'\nTargets: {opt.target}\n')
+    sys.stderr.write(f'Member sequences: {opt.members}\n\n')
+
+    species = None
+    if opt.members == 'target':
+        # union of the target organisms of all sets
+        species = list(dict.fromkeys(t for name in target_sets for t in target_sets[name]))
+    og = Orthogroup(opt.orthogroup, storage=opt.storage, cache=opt.cache, workers=opt.workers,
+                    species=species, sparse=opt.sparse and not opt.chunk)
     n_proteome = og.proteome_read()
     sys.stderr.write(f'{n_proteome} sequence file names read\n')
-    n_seq = og.groups_read()
-    sys.stderr.write(f'{n_seq} orthogroup sequences read\n\n')
+
+    # cached results depend only on the orthogroups and the normalization
+    result_cache = None
+    cached = None
+    if opt.result_cache:
+        result_cache = ResultCache(opt.result_cache, limit=int(opt.cache_limit * (1 << 20)))
+        cache_key = result_cache.key(opt.orthogroup, method=opt.method, ignore_zero=opt.ignore_zero,
+                                     log1p=opt.log1p,
+                                     fraction=opt.fraction if opt.method == 'trimmed' else None)
+        cached = result_cache.load(cache_key)
+        sys.stderr.write(f'Result cache {"hit" if cached else "miss"}: {cache_key}\n')
+
+    if opt.chunk:
+        # counts are read while they are normalized, see stream_rank()
+        sys.stderr.write('\n')
+    elif cached:
+        # members of the reported groups are read from ORTHOGROUP, as for --genecount
+        og.counts = cached['counts']
+        og.storage = 'fetch'
+        og.group = FetchedGroups(og)
+        sys.stderr.write(f'{int(og.counts.sum())} orthogroup sequences in result cache\n\n')
+    elif opt.genecount:
+        n_seq = og.genecount_read(opt.genecount)
+        sys.stderr.write(f'{n_seq} orthogroup sequences read\n\n')
+    elif opt.members == 'none' and not opt.cache:
+        # only the counts, members are resolved from ORTHOGROUP when they are needed
+        n_seq = og.counts_read()
+        sys.stderr.write(f'{n_seq} orthogroup sequences counted\n\n')
+    else:
+        n_seq = og.groups_read()
+        sys.stderr.write(f'{n_seq} orthogroup sequences read\n\n')
 
     # make a trimmed list of genome names (part up to first underline)
     organism = {}
@@ -182,60 +770,164 @@ if __name__ == '__main__':
         organism[field[0]] = p
         orgidx.append(field[0])
 
-    # normalize the count data so that each row is a standard normal deviate, using trimmed mean
-    # and STD dev.
-
-    cols = []
-    for t in target:
-        try:
-            cols.append(organism[t])
-        except KeyError:
-            sys.stderr.write(f'Unknown organism ({t})')
-            exit(2)
+    # indicator matrix of target sets, one row per set, and the target columns of each set
+    indicator = target_matrix(target_sets, organism, n_proteome)
+    target_cols = [[organism[t] for t in target_sets[name]] for name in target_sets]
 
     # summary of source sequences for looking up fasta
-    json_out = {'source_data': {}}
+    source_data = {}
     print(f'Source Data:')
     for p in range(len(og.proteome)):
         print(f'{orgidx[p]}\t{og.proteome[p]}')
-        json_out['source_data'][orgidx[p]] = og.proteome[p]
+        source_data[orgidx[p]] = og.proteome[p]
+
+    if opt.sweep:
+        # trim fraction sweep, report only the group numbers and z-scores for each fraction
+        json_out = {'source_data': source_data}
+        cols = np.flatnonzero(indicator[0]).tolist()
+        fractions = [float(f) for f in opt.sweep.split(',')]
+        selected, json_out['Sweep'] = fraction_sweep(og, fractions, cols, opt.ntop, opt.ignore_zero,
+                                                     opt.log1p)
+        tsv_write(opt, [f'{f:g}' for f in fractions], selected)
+        for fraction in fractions:
+            print(f'\nTrim fraction {fraction:g}')
+            for direction in ('Reduced', 'Expanded'):
+                print(f'\t{direction}')
+                for g, zg in json_out['Sweep'][fraction][direction]:
+                    print(f'\t\tOrthogroup {g:6d}\t{zg:.3f}')
+
+        if opt.json:
+            jsonfile = open(opt.json, 'w')
+            json.dump(json_out, jsonfile, indent=2, cls=CompactJSONEncoder)
+            jsonfile.write('\n')
+            jsonfile.close()
+
+        exit(0)
 
+    # normalize the count data so that each row is a standard normal deviate, using trimmed mean
+    # and STD dev. The mean target z of each set is calculated from z in the same way in every
+    # path (target_means())
     print(f'\nExpanded/contracted Groups:')
-    z = trimmed_stats(og, opt.fraction)
-    selected = z[:, cols].mean(axis=1)
-    tsv_write(opt, orgidx, z)
-
-    n = 0
-    ranked = sorted(range(len(selected)), key=lambda g: selected[g])
-
-    print(f'\n{opt.ntop} most reduced in {target}')
-    reduced = []
-    for g in ranked[:opt.ntop]:
-        print(f'\nOrthogroup {g:6d}\t{selected[g]:.3f}')
-        this_group = {'og_num': g, 'z': selected[g], 'Members': []}
-        reduced.append(this_group)
-        members = this_group['Members']
-        for i in range(n_proteome):
-            print(f'\t{orgidx[i]}: {len(og.group[g][i])}\t{og.group[g][i]}')
-            members.append([orgidx[i], len(og.group[g][i])] + og.group[g][i])
-        json_out['Reduced'] = reduced
-
-    print(f'\n{opt.ntop} most expanded in {target}')
-    expanded = []
-    for g in ranked[-opt.ntop:]:
-        this_group = {'og_num': g, 'z': selected[g], 'Members': []}
-        expanded.append(this_group)
-        members = this_group['Members']
-        print(f'\nOrthogroup {g:6d}\t{selected[g]:.3f}')
-        for i in range(n_proteome):
-            print(f'\t{orgidx[i]}: {len(og.group[g][i])}\t{og.group[g][i]}')
-            members.append([orgidx[i], len(og.group[g][i])] + og.group[g][i])
-            if not og.group[g][i]:
-                members[-1].append('')
-
-    json_out['Expanded'] = expanded
-    if jsonfile:
-        jsonfile.write(f'{json.dumps(json_out, indent=2, cls=CompactJSONEncoder)}\n')
-        jsonfile.close()
+    set_stats = [{} for _ in target_sets]
+    exact = [None for _ in target_sets]
+    if opt.chunk:
+        # only the reported groups are kept: og.counts and og.group are dictionaries indexed by
+        # orthogroup number
+        ranking, set_selected, og.counts = stream_rank(opt, og, target_cols, orgidx)
+        if opt.members != 'none':
+            og.members_fetch([g for bottom, top in ranking for g in bottom + top])
+        og.group = og.fetched
+        z = None
+    elif og.sparse:
+        # z is normalized one block of rows at a time for the mean target z, the full z is only
+        # needed for permutations
+        ave, std = trimmed_ave_std(og.counts, opt.fraction, ignore_zero=opt.ignore_zero,
+                                   method=opt.method, log1p=opt.log1p)
+        nrow = og.counts.shape[0]
+        chunk = 1 << 16
+        set_z = np.empty((nrow, len(target_sets)))
+        for begin in range(0, nrow, chunk):
+            end = min(begin + chunk, nrow)
+            z = normalize(og.counts[begin:end], ave[begin:end], std[begin:end], log1p=opt.log1p)
+            set_z[begin:end] = target_means(z, target_cols)
+        set_selected = [set_z[:, s] for s in range(len(target_sets))]
+        z = None
+        if opt.permutations:
+            z = normalize(og.counts, ave, std, log1p=opt.log1p)
+    else:
+        if cached:
+            z = cached['z']
+        else:
+            ave, std = trimmed_ave_std(og.counts, opt.fraction, ignore_zero=opt.ignore_zero,
+                                       method=opt.method, log1p=opt.log1p)
+            z = normalize(og.counts, ave, std, log1p=opt.log1p)
+            if result_cache:
+                result_cache.save(cache_key, {'counts': og.counts, 'z': z, 'ave': ave, 'std': std},
+                                  {'orthogroups': os.path.abspath(opt.orthogroup),
+                                   'proteome': og.proteome})
+        set_z = target_means(z, target_cols)
+        set_selected = [set_z[:, s] for s in range(len(target_sets))]
+
+    # per set statistics for each orthogroup: permutation p-values and BH q-values for contraction
+    # (reduced) and expansion, and two sample tests of target vs. other counts
+    for s, name in enumerate(target_sets):
+        if opt.permutations:
+            p_low, p_high, exact[s] = permutation_test(z, set_z[:, s], int(indicator[s].sum()),
+                                                       opt.permutations, seed=opt.seed,
+                                                       workers=opt.workers)
+            set_stats[s].update({'p_reduced': p_low, 'q_reduced': bh_qvalues(p_low),
+                                 'p_expanded': p_high, 'q_expanded': bh_qvalues(p_high)})
+            sys.stderr.write(f'Permutation test {name}: exact={exact[s]}\n')
+
+        if opt.tests:
+            cols = np.flatnonzero(indicator[s])
+            set_stats[s].update(target_tests(og.counts, cols, pseudocount=opt.pseudocount))
+
+    # statistics follow the normalized counts
+    labels = list(orgidx)
+    columns = []
+    for name, stats in zip(target_sets, set_stats):
+        for column in stats:
+            labels.append(f'{name}:{column}' if opt.batch else column)
+            columns.append(stats[column])
+
+    if opt.chunk:
+        # z was written by stream_rank()
+        pass
+    elif og.sparse:
+        tsv_normalized(opt, labels, og.counts, ave, std, columns, log1p=opt.log1p)
+    elif columns:
+        tsv_write(opt, labels, np.hstack([z] + [column[:, None] for column in columns]))
+    else:
+        tsv_write(opt, orgidx, z)
+
+    if not opt.chunk:
+        # top and bottom groups by partial selection, ties are ordered by orthogroup number
+        ranking = []
+        for s in range(len(target_sets)):
+            bottom, top = extremes(set_z[:, s], opt.ntop)
+            ranking.append((bottom.tolist(), top.tolist()))
+        if og.storage == 'fetch' and opt.members != 'none':
+            # read the members of the reported groups of all sets in a single pass
+            og.members_fetch([g for bottom, top in ranking for g in bottom + top])
+
+    for s, name in enumerate(target_sets):
+        target = target_sets[name]
+        selected = set_selected[s]
+        bottom, top = ranking[s]
+        if opt.batch:
+            print(f'\nTarget set {name}')
+
+        json_out = {'source_data': source_data}
+        if opt.members == 'none':
+            # outliers_fasta.py reads the members of the reported groups from this file
+            json_out['orthogroups'] = os.path.abspath(opt.orthogroup)
+        if opt.permutations:
+            json_out['Permutations'] = {'n': opt.permutations, 'seed': opt.seed, 'exact': exact[s]}
+
+        # each direction reports its own permutation p and q
+        reduced = {}
+        expanded = {}
+        for column in set_stats[s]:
+            if column.endswith('_reduced'):
+                reduced[column[0]] = set_stats[s][column]
+            elif column.endswith('_expanded'):
+                expanded[column[0]] = set_stats[s][column]
+            else:
+                reduced[column] = expanded[column] = set_stats[s][column]
+
+        print(f'\n{opt.ntop} most reduced in {target}')
+        json_out['Reduced'] = group_report(og, orgidx, selected, bottom, stats=reduced,
+                                           counts_only=opt.members == 'none')
+
+        print(f'\n{opt.ntop} most expanded in {target}')
+        json_out['Expanded'] = group_report(og, orgidx, selected, top, blank=True, stats=expanded,
+                                            counts_only=opt.members == 'none')
+
+        if opt.json:
+            jsonfile = open(json_name(opt.json, name, opt.batch), 'w')
+            json.dump(json_out, jsonfile, indent=2, cls=CompactJSONEncoder)
+            jsonfile.write('\n')
+            jsonfile.close()
 
     exit(0)
@@ -7,13 +7,12 @@ Retrieve the fasta sequences for the expanded and contracted orthogroups
 ================================================================================================="""
 import argparse
 import datetime
+import os
 import sys
 import json
 
-# import numpy as np
-# from scipy.stats.mstats import trimmed_mean, trimmed_std
-#
-# from orthogroups import Orthogroup
+from sequence.fasta import Fasta
+from orthogroups import Orthogroup, SequenceIndex
 
 
 def process_command_line():
@@ -40,6 +39,17 @@ def process_command_line():
                     type=str,
                     default='outlier')
 
+    cl.add_argument('-d', '--dir',
+                    help='directory with the proteome FastA files listed in the JSON source_data',
+                    type=str,
+                    default='./')
+
+    cl.add_argument('-g', '--orthogroup',
+                    help='Orthogroups.tsv file for JSON written with outliers.py --members none '
+                         '(default: the file recorded in the JSON)',
+                    type=str,
+                    default='')
+
     return cl.parse_args()
 
 
@@ -76,9 +86,10 @@ def make_sequence_list(seqdict, group, n_max):
 
             species = member[0]
             nseq = member[1]
-            for i in range(2, nseq + 2):
-                # print(f'{species}\t{og_num}\t{member[i]}')
-                seqdict[species]['id'].append(member[i])
+            # members may be missing if outliers.py only loaded the target organisms
+            for sequence in member[2:nseq + 2]:
+                # print(f'{species}\t{og_num}\t{sequence}')
+                seqdict[species]['id'].append(sequence)
                 seqdict[species]['og_num'].append(og_num)
                 nseqs += 1
         if ngroups > n_max:
@@ -87,6 +98,57 @@ def make_sequence_list(seqdict, group, n_max):
     return ngroups, nseqs
 
 
+def members_resolve(filename, top):
+    """---------------------------------------------------------------------------------------------
+    JSON written with outliers.py --members none has only the counts of each group. Read the
+    members of all the reported groups from the orthogroups file in a single pass
+    (Orthogroup.members_fetch()) and add them to the groups in the same form as the full JSON,
+    'Members': [[species, count, seq, ...], ...]
+
+    :param filename: string     Orthogroups.tsv file used by outliers.py
+    :param top: dict            outliers.py JSON, Expanded and Reduced groups are modified
+    :return: int                number of groups resolved
+    ---------------------------------------------------------------------------------------------"""
+    groups = [og for direction in ('Expanded', 'Reduced') for og in top[direction]
+              if 'Members' not in og]
+    if not groups:
+        return 0
+    if not filename:
+        sys.stderr.write('outliers_fasta - JSON has no members and no orthogroup file is given\n')
+        exit(1)
+
+    og = Orthogroup(filename)
+    og.proteome_read()
+    organism = [proteome.split('_')[0] for proteome in og.proteome]
+    og.members_fetch([group['og_num'] for group in groups])
+    for group in groups:
+        row = og.fetched[group['og_num']]
+        group['Members'] = [[organism[i], len(row[i])] + row[i] for i in range(len(organism))]
+
+    return len(groups)
+
+
+def make_index(index, group, n_max, prefix):
+    """---------------------------------------------------------------------------------------------
+    Add the member sequences of the selected orthogroups to a reverse index so that sequences read
+    from the proteome files can be routed to the orthogroup output files. The orthogroups are named
+    <prefix><og_num>, e.g., e568
+
+    :param index: SequenceIndex     reverse index, sequence name -> orthogroup, species
+    :param group: list of dict      dict holds the member sequences of each selected orthogroup
+    :param n_max: int               maximum number of groups to add to index
+    :param prefix: string           prefix for orthogroup names, e.g. 'e' or 'r'
+    :return: int                    number of groups added
+    ---------------------------------------------------------------------------------------------"""
+    ngroups = 0
+    for og in group[:n_max]:
+        row = [member[2:member[1] + 2] for member in og['Members'] if member]
+        index.add(row, f'{prefix}{og["og_num"]}')
+        ngroups += 1
+
+    return ngroups
+
+
 # ==================================================================================================
 # Main
 # ==================================================================================================
@@ -120,6 +182,12 @@ if __name__ == '__main__':
     sys.stderr.write(f'Highest groups: {top_n}\n')
     sys.stderr.write(f'Lowest groups: {bottom_n}\n\n')
 
+    # counts only JSON (outliers.py --members none), members are read from the orthogroups file
+    orthogroup = opt.orthogroup or top.get('orthogroups', '')
+    nresolved = members_resolve(orthogroup, top)
+    if nresolved:
+        sys.stderr.write(f'Members of {nresolved} groups read from {orthogroup}\n')
+
     # for each sequence, make a list of all the sequences
     # protein sequence file names are in top['source_data']
     # sequences for each orthogroup are in top['Expanded'|'Reduced']['Members']
@@ -128,12 +196,41 @@ if __name__ == '__main__':
     nred, nseqred = make_sequence_list(sequences, top['Reduced'], bottom_n)
     sys.stderr.write(f'{nseqexp+nseqred} sequences will be read for {nexp+nred} groups\n')
 
+    # reverse index from sequence name to the selected orthogroups, used to route the sequences
+    # as each proteome file is read
+    index = SequenceIndex()
+    make_index(index, top['Expanded'], top_n, 'e')
+    make_index(index, top['Reduced'], bottom_n, 'r')
+    index.finish()
+
     # set up output files for sequences
     # names are opt.<prefix>_<e|r><og_num>.fa, e.g. cold_e568.fa
     # files need to opened simultaneously because each sequence has entries in each orthogroup
-    files = {}
-    ngroup = 0
-    for og in top['Expanded']:
-        fname = f'opt.prefix + '_r' + og['og_num'] +
+    files = []
+    for name in index.name:
+        fname = f'{opt.prefix}_{name}.fa'
+        try:
+            files.append(open(fname, 'w'))
+        except OSError:
+            sys.stderr.write(f'outliers_fasta - unable to open output file ({fname})\n')
+            exit(2)
+
+    # read each proteome that has selected sequences and write the sequences to their orthogroup
+    nwritten = 0
+    for species in sequences:
+        if not sequences[species]['id']:
+            continue
+
+        fasta = Fasta(filename=os.path.join(opt.dir, top['source_data'][species]), mode='r')
+        for _ in fasta:
+            found = index.lookup(fasta.id)
+            if found:
+                files[found[0]].write(fasta.format())
+                nwritten += 1
+
+    for fh in files:
+        fh.close()
+
+    sys.stderr.write(f'{nwritten} sequences written to {len(files)} files\n')
 
     exit(0)